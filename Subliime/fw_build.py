@@ -1,12 +1,18 @@
 import sublime
 import sublime_plugin
 
+import codecs
+import csv
+import functools
+import json
+from collections import namedtuple
 import subprocess
 import threading
 import os
 import re
 import signal
 import sys
+import time
 
 class FwBuildCommand(sublime_plugin.WindowCommand):
 
@@ -17,6 +23,21 @@ class FwBuildCommand(sublime_plugin.WindowCommand):
     panel_lock = threading.Lock()
     THOR_MAKE_PATH = 'main/Cumulus/firmware/THOR'
     CHIMP_MAKE_PATH = 'main/Cumulus/firmware/ChiMP/bootcode'
+    # The output is written to the panel at most every FLUSH_INTERVAL ms,
+    # or as soon as FLUSH_SIZE characters are waiting. The reader waits
+    # while MAX_BUFFER_SIZE characters are waiting, and the oldest output
+    # is dropped once the panel holds more than MAX_PANEL_SIZE characters.
+    FLUSH_INTERVAL = 50
+    FLUSH_SIZE = 64 * 1024
+    MAX_BUFFER_SIZE = 1024 * 1024
+    MAX_PANEL_SIZE = 4 * 1024 * 1024
+    # The most bytes of build output read at a time, a build variant
+    # can set read_size instead
+    READ_SIZE = 64 * 1024
+    # The most translated paths remembered
+    PATH_CACHE_SIZE = 4096
+    # The number of slowest steps the timing summary shows
+    TIMING_TOP = 10
 
     def is_enabled(self, kill=False):
         # The Cancel build option should only be available
@@ -25,12 +46,14 @@ class FwBuildCommand(sublime_plugin.WindowCommand):
             return self.proc is not None and self.proc.poll() is None
         return True
 
-    def run(self, chip="thor", build_type="release", sign=False, kill=False):
+    def run(self, chip="thor", build_type="release", sign=False, kill=False,
+            read_size=None):
         self._local_make_path = None
         self.repo = None
         self.chip = chip
         self.build_type = build_type
         self.sign = sign
+        self.read_size = read_size or self.READ_SIZE
 
         if kill:
             if self.proc:
@@ -39,6 +62,12 @@ class FwBuildCommand(sublime_plugin.WindowCommand):
                 self.proc.terminate()
             return
         self.get_repo()
+        # The paths are relative to the make path of this build. It is
+        # bound into the translator of the build, so a cancel or the next
+        # build can't change it under the reader and the pending flushes,
+        # and each build gets its own cache
+        self.translate = functools.lru_cache(maxsize=self.PATH_CACHE_SIZE)(
+            functools.partial(translate_path, self.local_make_path))
 
         # A lock is used to ensure only one thread is
         # touching the output panel at a time
@@ -55,20 +84,39 @@ class FwBuildCommand(sublime_plugin.WindowCommand):
 
             self.window.run_command('show_panel', {'panel': 'output.exec'})
 
+        self.writer = PanelWriter(
+            functools.partial(self.do_write, self.translate),
+            self.FLUSH_INTERVAL,
+            self.FLUSH_SIZE,
+            self.MAX_BUFFER_SIZE
+        )
+        # The next error and failing files commands of this window
+        # look the diagnostics up here
+        self.index = BuildIndex(self.translate)
+        build_indexes[self.window.id()] = self.index
+        self.report_path = os.path.join(
+            sublime.cache_path(), 'FWBuild',
+            'timing-%s-%s' % (self.chip, self.build_type))
+
         if self.proc is not None:
             self.proc.terminate()
             self.proc = None
 
+        # Unbuffered, so that a read returns whatever output is there
+        # instead of waiting for the read size to fill up
         self.proc = subprocess.Popen(
             self.build_args(),
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
+            stderr=subprocess.STDOUT,
+            bufsize=0
         )
         self.killed = False
 
+        # The reader keeps its own writer, so the reader of a
+        # cancelled build can't close the writer of the next one
         threading.Thread(
             target=self.read_handle,
-            args=(self.proc.stdout,)
+            args=(self.proc.stdout, self.writer, self.index)
         ).start()
 
     def build_args(self) -> list:
@@ -108,47 +156,71 @@ class FwBuildCommand(sublime_plugin.WindowCommand):
         sublime.status_message(f"build command: {args}")
         return args
 
-    def read_handle(self, handle):
-        chunk_size = 2 ** 10
-        out = b''
-        while True:
-            try:
-                data = os.read(handle.fileno(), chunk_size)
-                # If exactly the requested number of bytes was
-                # read, there may be more data, and the current
-                # data may contain part of a multibyte char
-                out += data
-                if len(data) == chunk_size:
-                    continue
-                if data == b'' and out == b'':
-                    raise IOError('EOF')
-                # We pass out to a function to ensure the
-                # timeout gets the value of out right now,
-                # rather than a future (mutated) version
-                self.queue_write(out.decode(self.encoding))
-                if data == b'':
-                    raise IOError('EOF')
-                out = b''
-            except (UnicodeDecodeError) as e:
-                msg = 'Error decoding output using %s - %s'
-                self.queue_write(msg  % (self.encoding, str(e)))
-                break
-            except (IOError):
+    def read_handle(self, handle, writer, index):
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        # Every read goes into the same buffer
+        buf = bytearray(self.read_size)
+        view = memoryview(buf)
+        message = None
+        try:
+            while True:
+                n = handle.readinto(buf)
+                # The decoder keeps the start of a multibyte char
+                # that is split between reads until the rest of it
+                # is read
+                text = decoder.decode(view[:n], final=not n)
+                if text:
+                    index.feed(text)
+                    writer.write(text)
+                if not n:
+                    break
+        except (UnicodeDecodeError) as e:
+            msg = 'Error decoding output using %s - %s'
+            message = msg % (self.encoding, str(e))
+        except (IOError):
+            pass
+        except Exception as e:
+            message = '\n[Error reading the build output - %s]' % e
+            raise
+        finally:
+            # However the reader ends, the index is closed and the panel
+            # gets its end marker
+            index.close()
+            if message is None:
                 if self.killed:
-                    msg = 'Cancelled'
+                    message = '\n[Cancelled]'
                 else:
-                    msg = 'Finished'
-                self.queue_write('\n[%s]' % msg)
-                break
+                    message = self.report_timing(index) + '\n[Finished]'
+            writer.close(message)
 
-    def queue_write(self, text):
-        sublime.set_timeout(lambda: self.do_write(text), 30)
+    def report_timing(self, index):
+        """Write the timing report of a finished build and return its
+        summary for the panel.
+        """
+        report = index.timing_report()
+        if not report['steps']:
+            return ''
+        report['chip'] = self.chip
+        report['build_type'] = self.build_type
+        try:
+            write_timing_report(report, self.report_path)
+        except OSError as e:
+            return '\nError writing the timing report: %s' % e
+        return timing_summary(report, self.TIMING_TOP, self.report_path)
 
-    def do_write(self, text):
+    def do_write(self, translate, text):
         text = remove_ansi_ctrl(text)
-        text = self.translate_file_paths(text)
+        text = translate_file_paths(text, translate)
         with self.panel_lock:
             self.panel.run_command('append', {'characters': text})
+            size = self.panel.size()
+            if size > self.MAX_PANEL_SIZE:
+                # Trim to a quarter below the cap so that it isn't
+                # done again on every flush
+                self.panel.run_command(
+                    'fw_build_trim_panel',
+                    {'size': size - self.MAX_PANEL_SIZE * 3 // 4}
+                )
 
     def get_repo(self):
         """Find the git repo.
@@ -169,36 +241,6 @@ class FwBuildCommand(sublime_plugin.WindowCommand):
         raise ValueError(err_msg)
 
 
-    def translate_file_paths(self, text):
-        regexs = [
-            # Example: ../Primate/grc.c:561:9: error: 'ELAS_PR_TMR_PRIORITY' undeclared (first use in this function)
-            r"(?P<before>^)(?P<filename>\S+)(?P<after>:\d+:\d+:\s+.*)",
-            # Example: Compiling: ../Primate/main_srt.c
-            r"(?P<before>^Compiling:\s+)(?P<filename>\S+)(?P<after>.*)",
-            # Example: ../Primate/grc.c: In function 'grc_hisr_func':
-            r"(?P<before>^)(?P<filename>\S+)(?P<after>\s+In function .*)",
-            # Example: Linking: THORB0_DUAL_SIGNED_0001_0001/srt_bootcode.out
-            r"(?P<before>^Linking:\s*)(?P<filename>\S+)(?P<after>.*)",
-            # Example: Generating THORB0_DUAL_SIGNED_0001_0001/srt.bin file
-            r"(?P<before>^Generating\s+)(?P<filename>\S+)(?P<after>.*)",
-            # Example: Created THORB0_DUAL_SIGNED_0001_0001/srt_thor.signed.rev0001.bin
-            r"(?P<before>^Created\s+)(?P<filename>\S+)(?P<after>.*)",
-        ]
-        new_lines = []
-        for line in text.splitlines():
-            line = line.rstrip('\r\n')
-            for regex in regexs:
-                match = re.search(regex, line)
-                if match:
-                    new_filename = self.translate_path(match.group("filename"))
-                    line = match.group("before") + new_filename + match.group("after")
-                    break
-            new_lines.append(line + '\n')
-        return ''.join(new_lines)
-
-    def translate_path(self, path):
-        return os.path.abspath(os.path.join(self.local_make_path, path))
-
     @property
     def local_make_path(self):
         if self._local_make_path is None:
@@ -208,10 +250,404 @@ class FwBuildCommand(sublime_plugin.WindowCommand):
                 self._local_make_path = os.path.join(self.repo + self.CHIMP_MAKE_PATH)
             else:
                 raise ValueError("Unsupported chip {chip}".format(chip=self.chip))
-        print(f"local_make_path: {self._local_make_path}")
+            print(f"local_make_path: {self._local_make_path}")
         return self._local_make_path
 
 
+class FwBuildTrimPanelCommand(sublime_plugin.TextCommand):
+    """Erase the oldest output of the build panel.
+
+    The first size characters are erased, up to the end of the line
+    the last of them is on.
+    """
+
+    def run(self, edit, size):
+        end = self.view.full_line(size).end()
+        self.view.erase(edit, sublime.Region(0, end))
+
+
+class FwBuildNextErrorCommand(sublime_plugin.WindowCommand):
+    """Open the file of the next error of the last build.
+
+    After the last error it starts over at the first one.
+    """
+
+    def is_enabled(self):
+        index = build_indexes.get(self.window.id())
+        return index is not None and bool(index.errors)
+
+    def run(self):
+        index = build_indexes.get(self.window.id())
+        diagnostic = index.next_error() if index else None
+        if diagnostic is None:
+            sublime.status_message("No build errors")
+            return
+        open_diagnostic(self.window, diagnostic)
+        sublime.status_message(diagnostic.message)
+
+
+class FwBuildFailingFilesCommand(sublime_plugin.WindowCommand):
+    """List the files with errors of the last build in a quick panel.
+
+    Picking a file opens it at its first error.
+    """
+
+    def is_enabled(self):
+        index = build_indexes.get(self.window.id())
+        return index is not None and bool(index.errors)
+
+    def run(self):
+        index = build_indexes.get(self.window.id())
+        files = index.failing_files() if index else []
+        if not files:
+            sublime.status_message("No build errors")
+            return
+        items = [
+            [path, "%d errors, %d warnings" % (errors, warnings)]
+            for path, errors, warnings, first in files
+        ]
+
+        def on_done(n):
+            if n >= 0:
+                open_diagnostic(self.window, files[n][3])
+
+        self.window.show_quick_panel(items, on_done)
+
+
+def open_diagnostic(window, diagnostic):
+    window.open_file(
+        "%s:%d:%d" % (diagnostic.path, diagnostic.line, diagnostic.col),
+        sublime.ENCODED_POSITION
+    )
+
+
+# severity is error, fatal error, warning or note
+Diagnostic = namedtuple('Diagnostic', 'path line col severity message')
+# kind is Compiling or Linking, start the seconds since the build started
+# and read the number of the read of the output the line came in
+Step = namedtuple('Step', 'kind path start read')
+
+
+def translate_path(make_path, path):
+    """Return the local path of a path of the build output, which is
+    relative to the make path of the build.
+    """
+    return os.path.abspath(os.path.join(make_path, path))
+
+
+def translate_file_paths(text, translate):
+    """Return text with the file path of each line translated."""
+    new_lines = []
+    for line in text.splitlines():
+        match = file_path_regex.match(line)
+        if match:
+            # Only the group of the pattern that matched is set
+            group = match.lastindex
+            line = (line[:match.start(group)] +
+                    translate(match.group(group)) +
+                    line[match.end(group):])
+        new_lines.append(line + '\n')
+    return ''.join(new_lines)
+
+
+def write_timing_report(report, path):
+    """Write a timing report as path.json, and its steps as path.csv."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(path + '.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['kind', 'path', 'start', 'seconds'])
+        for step in report['steps']:
+            writer.writerow([step['kind'], step['path'], step['start'],
+                             step['seconds']])
+
+
+def timing_summary(report, top, path):
+    """Return the build time, the critical path and the top slowest
+    steps of a timing report.
+
+    When steps were read together their times are unknown, so only the
+    build time is shown.
+    """
+    lines = ['']
+    if report['shared']:
+        lines.append('Build time %.1fs, %d steps, %d of them read together '
+                     'with the next one so the step times are unknown' % (
+                         report['seconds'], len(report['steps']),
+                         report['shared']))
+    else:
+        lines.append('Build time %.1fs, critical path %.1fs over %d steps%s'
+                     % (report['seconds'], report['critical_path']['seconds'],
+                        len(report['critical_path']['steps']),
+                        ' (approximate, parallel build)'
+                        if report['parallel'] else ''))
+        lines.append('Slowest steps:')
+        steps = sorted(report['steps'], key=lambda step: -step['seconds'])
+        for step in steps[:top]:
+            lines.append('%8.1fs  %s %s' % (step['seconds'], step['kind'],
+                                            step['path']))
+    lines.append('Timing report: %s.json' % path)
+    return '\n'.join(lines)
+
+
+class BuildIndex:
+    """The diagnostics and build steps found in the output of a build.
+
+    The reader thread feeds the output to the index as it is read, so
+    the commands that navigate the errors don't have to scan the panel.
+    A partial last line is kept until the rest of it is read.
+
+    diagnostics are the file:line:col errors, warnings and notes in the
+    order they were printed, errors the ones of them that are errors, and
+    steps are the Compiling and Linking lines with the time they were
+    read. The paths are translated like the panel shows them. parallel is
+    set when the output shows a make -j.
+    """
+
+    def __init__(self, translate):
+        self.translate = translate
+        self.lock = threading.Lock()
+        self.partial = ''
+        self.diagnostics = []
+        self.errors = []
+        self.steps = []
+        self.position = -1
+        self.reads = 0
+        self.parallel = False
+        self.started = time.monotonic()
+        self.finished = None
+
+    def feed(self, text):
+        self.reads += 1
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        self.add_lines(lines)
+
+    def close(self):
+        self.add_lines([self.partial])
+        self.partial = ''
+        self.finished = time.monotonic()
+
+    def add_lines(self, lines):
+        diagnostics = []
+        steps = []
+        for line in lines:
+            if '\x1b' in line:
+                line = remove_ansi_ctrl(line)
+            match = index_regex.match(line)
+            if not match:
+                if line.startswith('make') and parallel_regex.match(line):
+                    self.parallel = True
+                continue
+            path, line_no, col, severity, message, step, step_path = \
+                match.groups()
+            if step:
+                # Each step is timed as its line is split off, but the
+                # steps of one read still start at about the same time
+                steps.append(Step(step, self.translate(step_path),
+                                  time.monotonic() - self.started,
+                                  self.reads))
+            else:
+                diagnostics.append(Diagnostic(
+                    self.translate(path), int(line_no), int(col),
+                    severity, message.strip()))
+        if diagnostics or steps:
+            with self.lock:
+                self.diagnostics.extend(diagnostics)
+                self.errors.extend(d for d in diagnostics
+                                   if d.severity.endswith('error'))
+                self.steps.extend(steps)
+
+    def next_error(self):
+        with self.lock:
+            if not self.errors:
+                return None
+            self.position = (self.position + 1) % len(self.errors)
+            return self.errors[self.position]
+
+    def failing_files(self):
+        """Return (path, errors, warnings, first error) of each file
+        with errors, in the order of their first error.
+        """
+        files = {}
+        with self.lock:
+            for d in self.diagnostics:
+                counts = files.setdefault(d.path, [0, 0, None])
+                if d.severity == 'warning':
+                    counts[1] += 1
+                elif d.severity.endswith('error'):
+                    counts[0] += 1
+                    if counts[2] is None:
+                        counts[2] = d
+        return [(path, errors, warnings, first)
+                for path, (errors, warnings, first) in files.items()
+                if errors]
+
+    def timing_report(self):
+        """Return the duration of each step and the critical path.
+
+        A step lasts until the next one starts, or the build ends, which
+        is only the time of the step for a serial build, to the
+        resolution of the reads. The links wait for the compiles before
+        them, the compiles between two links could run side by side, so
+        the critical path is the slowest compile between each two links
+        and the links.
+
+        The report is approximate for a parallel build, where the next
+        step starts before the last one is done, and shared counts the
+        steps read together with the next one, whose time is unknown.
+        """
+        with self.lock:
+            steps = list(self.steps)
+        end = (self.finished or time.monotonic()) - self.started
+        timings = []
+        shared = 0
+        for n, step in enumerate(steps):
+            if n + 1 < len(steps):
+                stop = steps[n + 1].start
+                shared += steps[n + 1].read == step.read
+            else:
+                stop = end
+            timings.append({'kind': step.kind, 'path': step.path,
+                            'start': round(step.start, 3),
+                            'seconds': round(stop - step.start, 3)})
+        path = []
+        slowest = None
+        for timing in timings:
+            if timing['kind'] == 'Compiling':
+                if slowest is None or timing['seconds'] > slowest['seconds']:
+                    slowest = timing
+                continue
+            if slowest:
+                path.append(slowest)
+                slowest = None
+            path.append(timing)
+        if slowest:
+            path.append(slowest)
+        return {
+            'seconds': round(end, 3),
+            'approximate': self.parallel or bool(shared),
+            'parallel': self.parallel,
+            'shared': shared,
+            'critical_path': {
+                'seconds': round(sum(t['seconds'] for t in path), 3),
+                'steps': [t['path'] for t in path],
+            },
+            'steps': timings,
+        }
+
+
+class PanelWriter:
+    """Coalesce the output of a build into few writes to the panel.
+
+    The reader thread adds text with write(), and the text waiting is
+    handed to callback on the UI thread every interval ms, or as soon as
+    flush_size characters are waiting, with a single call per flush.
+    write() blocks while max_size characters are waiting, so a build that
+    prints faster than the panel takes it is slowed down instead of
+    queueing without bound.
+
+    A partial last line is held back until the rest of it arrives, or
+    for at most interval ms, so the path translation sees whole lines.
+    close() adds the last text and flushes everything.
+    """
+
+    def __init__(self, callback, interval=50, flush_size=64 * 1024,
+                 max_size=1024 * 1024):
+        self.callback = callback
+        self.interval = interval
+        self.flush_size = flush_size
+        self.max_size = max_size
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.size = 0
+        self.scheduled = False
+        self.urgent = False
+        self.held = ''
+        self.held_since = 0
+        self.closed = False
+
+    def write(self, text):
+        with self.cond:
+            while self.size >= self.max_size and not self.closed:
+                self.cond.wait(1)
+            self.add(text)
+
+    def close(self, text=''):
+        with self.cond:
+            self.closed = True
+            self.add(text)
+
+    def add(self, text):
+        # Called with the lock held
+        self.chunks.append(text)
+        self.size += len(text)
+        if not self.scheduled:
+            self.scheduled = True
+            sublime.set_timeout(self.flush, self.interval)
+        if (self.size >= self.flush_size or self.closed) and not self.urgent:
+            self.urgent = True
+            sublime.set_timeout(self.flush, 0)
+
+    def flush(self):
+        with self.cond:
+            text = ''.join(self.chunks)
+            now = time.monotonic()
+            end = len(text)
+            if not self.closed and (text != self.held or now <
+                                    self.held_since + self.interval / 1000):
+                # A line longer than flush_size isn't held back
+                end = text.rfind('\n') + 1 or (
+                    end if end >= self.flush_size else 0)
+            if text[end:] != self.held:
+                self.held_since = now
+            self.held = text[end:]
+            self.chunks = [self.held] if self.held else []
+            self.size = len(self.held)
+            self.urgent = False
+            self.scheduled = bool(self.held)
+            if self.held:
+                sublime.set_timeout(self.flush, self.interval)
+            self.cond.notify_all()
+        if end:
+            self.callback(text[:end])
+
+
+# The lines that start with a file name relative to the make path, in the
+# order they are tried. The file name is the only group of each pattern.
+file_path_patterns = [
+    # Example: ../Primate/grc.c:561:9: error: 'ELAS_PR_TMR_PRIORITY' undeclared (first use in this function)
+    r"(\S+):\d+:\d+:\s",
+    # Example: Compiling: ../Primate/main_srt.c
+    r"Compiling:\s+(\S+)",
+    # Example: ../Primate/grc.c: In function 'grc_hisr_func':
+    r"(\S+)\s+In function ",
+    # Example: Linking: THORB0_DUAL_SIGNED_0001_0001/srt_bootcode.out
+    r"Linking:\s*(\S+)",
+    # Example: Generating THORB0_DUAL_SIGNED_0001_0001/srt.bin file
+    r"Generating\s+(\S+)",
+    # Example: Created THORB0_DUAL_SIGNED_0001_0001/srt_thor.signed.rev0001.bin
+    r"Created\s+(\S+)",
+]
+# All of them in one pass, the first that matches wins
+file_path_regex = re.compile('|'.join(
+    '(?:%s)' % pattern for pattern in file_path_patterns))
+
+
+# The diagnostics and build steps the BuildIndex records
+index_regex = re.compile(
+    r"(?:(\S+):(\d+):(\d+):\s+((?:fatal )?error|warning|note):\s*(.*)"
+    r"|(Compiling|Linking):\s*(\S+))"
+)
+
+# A make that runs the steps in parallel, so they overlap
+parallel_regex = re.compile(r'make\b.*\s-j')
+
+# The BuildIndex of the last build of each window, by window id
+build_indexes = {}
+
+
 # 7-bit C1 ANSI sequences
 ansi_escape = re.compile(r'''
     \x1B  # ESC
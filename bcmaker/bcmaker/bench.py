@@ -0,0 +1,188 @@
+"""
+Benchmarks for bcmaker.
+
+Run from the bcmaker directory of a checkout, which has the cmaker benchmarks next to it:
+
+  python -m bcmaker.bench argv --entries 100000
+  python -m bcmaker.bench throughput --entries 10000,100000,1000000 --save-baseline baseline.json
+  python -m bcmaker.bench throughput --entries 10000,100000,1000000 --baseline baseline.json
+  python -m bcmaker.bench startup --runs 50
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from bcmaker import bcmaker
+
+# The process isolation, baseline and startup timing helpers are shared with the cmaker benchmarks.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "cmaker"))
+from cmaker.bench import compare_baseline, run_isolated, time_commands  # noqa: E402
+
+# mode -> the options of a throughput case and if its output has to be the same as the default one
+modes = {
+    "load": ([], True),
+    "stream": (["--stream"], True),
+    "mmap": (["--mmap"], True),
+    "jobs": (["-j", "2"], True),
+    "regex": (["--legacy-regex"], True),
+    "incremental": (["--incremental"], True),
+    "group": (["-g", "flags"], False),
+}
+
+
+def generate_commands(nentries: int, seed: int = 1) -> list:
+    """
+    Return a deterministic compile database of nentries entries that looks like a Thor build.
+    """
+    return list(iter_commands(nentries, seed))
+
+
+def iter_commands(nentries: int, seed: int = 1):
+    """
+    Yield the entries of generate_commands one at a time.
+    """
+    rnd = random.Random(seed)
+    directory = "/git/int_nxt/main/Cumulus/firmware/THOR"
+    includes = ["../RTOS/Nucleus_3/{}".format(d) for d in ["os/include", "os/include/arch/arm", "os/kernel/plus",
+                                                           "bsp/primate_r8_thor/include"]]
+    includes += ["../../common/include/{}".format(n) for n in range(40)]
+    defines = ["USING_MGC", "NXT_CORE_FW", "__NO_STRING_INLINES", "TARGET_NUCLEUS", "NITRO_NUCLEUS_VERSION=3",
+               "LP64", "FIRMWARE_BC2", "BRCM_PRIMATE_MODS=1"] + ["FEATURE_{}=1".format(n) for n in range(60)]
+    for n in range(nentries):
+        source = "../core/module{}/file{}.c".format(n % 97, n)
+        arguments = ["arm-none-eabi-gcc"]
+        for inc in rnd.sample(includes, 30):
+            arguments += ["-I", inc] if rnd.random() < 0.5 else ["-I" + inc]
+        arguments += ["-U", "__INT32_TYPE__", "-D", "__INT32_TYPE__=int"]
+        arguments += ["-D" + define for define in rnd.sample(defines, 40)]
+        arguments += ["-mcpu=cortex-r7", "-mthumb", "-Og", "-g3", "-Werror", "-std=c99",
+                      '-D__FILE__="Cumulus/firmware/{}"'.format(source[3:]),
+                      "-oobj/file{}.o".format(n), "-c", source]
+        yield {"directory": directory, "arguments": arguments, "file": source}
+
+
+def write_commands(path: str, nentries: int, seed: int = 1) -> None:
+    """
+    Write the compile database of generate_commands to path without keeping it in memory.
+    """
+    with open(path, "w") as f:
+        f.write("[")
+        for n, obj in enumerate(iter_commands(nentries, seed)):
+            f.write(",\n  " if n else "\n  ")
+            json.dump(obj, f)
+        f.write("\n]\n")
+
+
+def bench_argv(nentries: int) -> None:
+    """
+    Compare the argument classifier against the original join-then-regex extraction.
+    """
+    commands = generate_commands(nentries)
+    times = {}
+    for name, legacy_regex in [("regex", True), ("argv", False)]:
+        bcmaker.make_relative.cache_clear()
+        start = time.perf_counter()
+        bcmaker.parse_batch(commands, legacy_regex=legacy_regex)
+        times[name] = time.perf_counter() - start
+
+    print("{} entries".format(nentries))
+    for name, elapsed in times.items():
+        print("{:5}: {:8.3f}s {:10.0f} entries/sec".format(name, elapsed, nentries / elapsed))
+    print("speedup: {:.2f}x".format(times["regex"] / times["argv"]))
+
+
+def run_case(sysargs: list, nentries: int) -> dict:
+    """
+    Run bcmaker.main with sysargs and return its speed, peak RSS and output digest.
+
+    Each case runs in a fresh process so the peak RSS is its own.
+    """
+    bcmaker.log.setLevel(logging.WARNING)
+    start = time.perf_counter()
+    bcmaker.main(sysargs)
+    elapsed = time.perf_counter() - start
+    with open(sysargs[sysargs.index("-o") + 1], "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return {"seconds": round(elapsed, 3), "entries_per_sec": round(nentries / elapsed),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "digest": digest}
+
+
+def bench_throughput(sizes: list, tmpdir: str) -> dict:
+    """
+    Measure bcmaker.main on generated compile databases of every size in every mode.
+
+    The output of every mode but group has to be the same as the one of the default mode.
+    """
+    cases = {}
+    for nentries in sizes:
+        cc_json = os.path.join(tmpdir, "compile_commands.{}.json".format(nentries))
+        write_commands(cc_json, nentries)
+        for mode, (options, equivalent) in modes.items():
+            name = "{}/{}".format(nentries, mode)
+            # Every case has its own output, and so its own index, so no case starts warm from another.
+            output = os.path.join(tmpdir, "CMakeLists.{}.{}.txt".format(nentries, mode))
+            case = run_isolated(run_case, ["-i", cc_json, "-o", output] + options, nentries)
+            cases[name] = case
+            same = case["digest"] == cases["{}/load".format(nentries)]["digest"] or not equivalent
+            print("{:24} {:10} entries/sec {:8} KiB{}".format(
+                name, case["entries_per_sec"], case["peak_rss_kb"], "" if same else "  OUTPUT DIFFERS FROM LOAD"))
+        os.remove(cc_json)
+    return cases
+
+
+def bench_startup(nruns: int, tmpdir: str) -> None:
+    """
+    Measure how long a bcmaker process takes to start, for the batch jobs that run it thousands of times.
+
+    The python case is the interpreter alone, the floor of the others.
+    """
+    cc_json = os.path.join(tmpdir, "compile_commands.json")
+    write_commands(cc_json, 10)
+    script = bcmaker.__file__
+    commands = {
+        "python": [sys.executable, "-c", "pass"],
+        "import": [sys.executable, "-c", "import bcmaker.bcmaker"],
+        "help": [sys.executable, script, "-h"],
+        "run": [sys.executable, script, "-i", cc_json, "-o", os.path.join(tmpdir, "CMakeLists.txt")],
+    }
+    time_commands(commands, os.path.dirname(os.path.dirname(script)), nruns)
+
+
+def main(sysargs):
+    parser = ArgumentParser(prog="python -m bcmaker.bench", description="bcmaker benchmarks")
+    parser.add_argument("bench", choices=["argv", "throughput", "startup"], help="the benchmark to run")
+    parser.add_argument("--entries", default="100000",
+                        help="the number of compile commands, a comma separated list for throughput. Default: 100000")
+    parser.add_argument("--baseline", help="compare the throughput results to this saved baseline")
+    parser.add_argument("--save-baseline", help="save the throughput results as a baseline to this file")
+    parser.add_argument("--runs", type=int, default=20, help="the number of runs of each startup case. Default: 20")
+    pargs = parser.parse_args(sysargs)
+    sizes = [int(size) for size in pargs.entries.split(",")]
+    if pargs.bench == "argv":
+        bench_argv(sizes[0])
+    elif pargs.bench == "startup":
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bench_startup(pargs.runs, tmpdir)
+    elif pargs.bench == "throughput":
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cases = bench_throughput(sizes, tmpdir)
+        if pargs.save_baseline:
+            with open(pargs.save_baseline, "w") as f:
+                json.dump(cases, f, indent=2, sort_keys=True)
+        if pargs.baseline:
+            with open(pargs.baseline) as f:
+                if not compare_baseline(cases, json.load(f), "entries_per_sec"):
+                    return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
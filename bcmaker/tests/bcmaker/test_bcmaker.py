@@ -0,0 +1,181 @@
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest import TestCase
+from bcmaker import bcmaker
+
+resources = os.path.join(os.path.dirname(__file__), "..", "resources")
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.input = os.path.join(resources, "compile_commands.json")
+        self.output = os.path.join(self.tmpdir.name, "CMakeLists.txt")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read_output(self) -> str:
+        with open(self.output) as f:
+            return f.read()
+
+    def test_main(self):
+        bcmaker.main(["-i", self.input, "-o", self.output])
+        output = self.read_output()
+        self.assertIn("add_executable(THOR", output)
+        self.assertIn("  USING_MGC\n", output)
+        self.assertIn("  ../RTOS/Nucleus_3/os/include\n", output)
+        self.assertNotIn("__FILE__", output)
+
+    def test_main_group_by_flags(self):
+        bcmaker.main(["-i", self.input, "-o", self.output, "-g", "flags"])
+        output = self.read_output()
+        self.assertNotIn("add_executable", output)
+        self.assertIn("add_library(THOR_001 OBJECT", output)
+        self.assertIn("target_compile_definitions(THOR_001 PRIVATE", output)
+        self.assertIn("target_include_directories(THOR_001 PRIVATE", output)
+
+    def test_iter_json(self):
+        expected = bcmaker.parse_json(self.input)
+        for use_mmap in [False, True]:
+            # Small chunks so objects and multibyte characters span chunks.
+            self.assertEqual(expected, list(bcmaker.iter_json(self.input, use_mmap, 1000)))
+
+    def test_iter_json_small(self):
+        path = os.path.join(self.tmpdir.name, "cc.json")
+        for text, expected in [("[]", []), (' [ {"a": "é"} ,{"b": []}\n]\n', [{"a": "é"}, {"b": []}])]:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            self.assertEqual(expected, list(bcmaker.iter_json(path, chunk_size=3)))
+        with open(path, "w") as f:
+            f.write('[{"a": 1}')
+        with self.assertRaises(ValueError):
+            list(bcmaker.iter_json(path))
+
+    def test_main_stream(self):
+        bcmaker.main(["-i", self.input, "-o", self.output])
+        expected = self.read_output()
+        bcmaker.main(["-i", self.input, "-o", self.output, "--mmap"])
+        self.assertEqual(expected, self.read_output())
+
+    def test_parse_cc_jobs(self):
+        commands = bcmaker.parse_json(self.input)
+        expected = bcmaker.parse_cc(commands, "flags")
+        self.assertEqual(expected, bcmaker.parse_cc(iter(commands), "flags", jobs=2, batch_size=7))
+
+    def test_command_string(self):
+        commands = bcmaker.parse_json(self.input)[:20]
+        expected = bcmaker.parse_cc(commands)
+        for obj in commands:
+            obj['command'] = " ".join(shlex.quote(arg) for arg in obj.pop('arguments'))
+        self.assertEqual(expected, bcmaker.parse_cc(commands))
+
+    def test_classify_args(self):
+        rsp = os.path.join(self.tmpdir.name, "flags.rsp")
+        with open(rsp, "w") as f:
+            f.write('-DFROM_RSP=1 -I "dir with spaces"\n')
+        args = ["gcc", "-U", "A", "-D", "A=int", "-DB", "-UB", "-Wp,-MD,-Dfoo.d", "-I", "inc", "-Iinc2",
+                "-isystem", "/usr/include", "-iquote./quote", "-include", "config.h", '-D__FILE__="x.c"',
+                "@flags.rsp", "-c", "x.c"]
+        defs, incs, system_incs = bcmaker.classify_args(args, self.tmpdir.name)
+        self.assertEqual(["A=int", "FROM_RSP=1"], defs)
+        self.assertEqual(["inc", "inc2", "dir with spaces"], incs)
+        self.assertEqual(["/usr/include", "./quote"], system_incs)
+
+    def test_system_includes(self):
+        # Toolchain dirs stay absolute, system dirs under the command directory become relative.
+        directory = "/git/int_nxt/main/Cumulus/firmware/THOR"
+        obj = {"directory": directory, "file": "../core/a.c",
+               "arguments": ["gcc", "-isystem", "/opt/tool/arm-none-eabi/include", f"-iquote{directory}/quote",
+                             "-idirafter", "after", "-I/git/int_nxt/main/Cumulus/common/include", "-c", "../core/a.c"]}
+        _, _, _, incs = bcmaker.parse_entry(obj)
+        self.assertEqual({"/opt/tool/arm-none-eabi/include", "quote", "after", "../.."}, incs)
+        cc_json = os.path.join(self.tmpdir.name, "compile_commands.json")
+        with open(cc_json, "w") as f:
+            json.dump([obj], f)
+        bcmaker.main(["-i", cc_json, "-o", self.output])
+        output = self.read_output()
+        self.assertIn("  /opt/tool/arm-none-eabi/include\n", output)
+        self.assertNotIn("../../../../../..", output)
+
+    def test_classify_args_matches_regex(self):
+        for obj in bcmaker.parse_json(self.input):
+            defs, incs, _ = bcmaker.classify_args(obj['arguments'], obj['directory'])
+            regex_defs, regex_incs = bcmaker.extract_regex(obj['arguments'])
+            self.assertEqual(set(regex_defs), set(defs))
+            self.assertEqual(set(regex_incs), set(incs))
+
+    def test_main_incremental(self):
+        bcmaker.main(["-i", self.input, "-o", self.output])
+        expected = self.read_output()
+        os.remove(self.output)
+
+        commands = bcmaker.parse_json(self.input)
+        cc_json = os.path.join(self.tmpdir.name, "compile_commands.json")
+        with open(cc_json, "w") as f:
+            json.dump(commands, f)
+        sysargs = ["-i", cc_json, "-o", self.output, "--incremental"]
+        with self.assertLogs(bcmaker.log) as logs:
+            bcmaker.main(sysargs)
+        self.assertIn(f"parsed {len(commands)} new or changed commands of {len(commands)}", "\n".join(logs.output))
+        self.assertEqual(expected, self.read_output())
+        self.assertTrue(os.path.isfile(self.output + ".index.json"))
+
+        # Unchanged input: the index is used without reading the input and the output is left alone.
+        with self.assertLogs(bcmaker.log) as logs:
+            bcmaker.main(sysargs)
+        self.assertIn("is unchanged since", "\n".join(logs.output))
+        self.assertIn(f"{self.output} is unchanged", "\n".join(logs.output))
+
+        # One changed command: only that command is parsed.
+        commands[0]['arguments'].append("-DINCREMENTAL")
+        with open(cc_json, "w") as f:
+            json.dump(commands, f)
+        with self.assertLogs(bcmaker.log) as logs:
+            bcmaker.main(sysargs)
+        self.assertIn(f"parsed 1 new or changed commands of {len(commands)}", "\n".join(logs.output))
+        self.assertIn("  INCREMENTAL\n", self.read_output())
+
+    def test_parse_cc_in_threads(self):
+        commands = bcmaker.parse_json(self.input)
+        halves = [commands[:len(commands) // 2], commands[len(commands) // 2:]]
+        expected = [bcmaker.parse_cc(half, "dir") for half in halves]
+        results = [None, None]
+        threads = [threading.Thread(target=lambda n=n: results.__setitem__(n, bcmaker.parse_cc(halves[n], "dir")))
+                   for n in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(expected, results)
+        self.assertNotEqual(results[0].exes, results[1].exes)
+        self.assertIsInstance(results[0].defs, frozenset)
+
+    def test_main_profile(self):
+        bcmaker.main(["-i", self.input, "-o", self.output])
+        expected = self.read_output()
+        os.remove(self.output)
+        stats = os.path.join(self.tmpdir.name, "stats")
+        with self.assertLogs(bcmaker.log) as logs:
+            bcmaker.main(["-i", self.input, "-o", self.output, "--profile", "--profile-out", stats])
+        self.assertEqual(expected, self.read_output())
+        output = "\n".join(logs.output)
+        for phase in bcmaker.Profile.phases + ["other", "total"]:
+            self.assertRegex(output, rf":{phase} +\d")
+        self.assertIn("commands: 600, dirs: 1, ", output)
+        self.assertTrue(os.path.isfile(stats))
+
+    def test_import_is_cheap(self):
+        # Importing bcmaker must not configure logging or load the modules only some runs need.
+        code = ("import logging, sys; from bcmaker import bcmaker; "
+                "print(len(logging.getLogger().handlers), "
+                "[m for m in ('multiprocessing', 'hashlib', 'mmap', 'shlex', 'cProfile') if m in sys.modules])")
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(bcmaker.__file__)),
+                                check=True, capture_output=True, text=True).stdout
+        self.assertEqual("0 []\n", output)
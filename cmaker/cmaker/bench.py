@@ -0,0 +1,322 @@
+"""
+Benchmarks for cmaker.
+
+Run from the cmaker directory:
+
+  python -m cmaker.bench logging --lines 1000000
+  python -m cmaker.bench reader --lines 1000000
+  python -m cmaker.bench throughput --lines 10000,100000,1000000 --save-baseline baseline.json
+  python -m cmaker.bench throughput --lines 10000,100000,1000000 --baseline baseline.json
+  python -m cmaker.bench startup --runs 50
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+
+from cmaker import cmaker
+
+# compiler -> the platform and build dir of the logs generate_log writes for it
+compilers = {
+    "gcc": ("bnxt-mt", "/git/int_nxt/main/Cumulus/util/bnxt-mt/build"),
+    "armcc": ("cmba", "/git/int_nxt/main/Cumulus/firmware/CMBA"),
+    "arm-none-eabi-gcc": ("thor", "/git/int_nxt/main/Cumulus/firmware/THOR"),
+}
+
+# mode -> the options of a throughput case and if its output has to be the same as the serial one.
+# The regex misses -D NAME with a space and grouping renders another layout, so those only
+# compare against the baseline.
+modes = {
+    "serial": ([], True),
+    "jobs": (["-j", "2"], True),
+    "cache": (["--cache"], True),
+    "regex": (["--legacy-regex"], False),
+    "group": (["-g", "flags"], False),
+}
+
+
+def generate_log(path: str, nlines: int, seed: int = 1, compiler: str = "gcc", compile_share: float = 0.3) -> None:
+    """
+    Write a deterministic build log of nlines lines for compiler.
+
+    gcc logs look like a bnxt-mt build, armcc and arm-none-eabi-gcc logs like a firmware build
+    with quoted __FILE__ defines and the paths the fixup rules look for. compile_share of the
+    lines are compile lines, the rest are make directory changes and noise.
+    """
+    if compiler != "gcc":
+        generate_firmware_log(path, nlines, seed, compiler, compile_share)
+        return
+    rnd = random.Random(seed)
+    dirs = ["/git/int_nxt/main/Cumulus/util/bnxt-mt/src/bnxtmt/{}".format(d)
+            for d in ["tcl/unix", "tcl/generic", "device/linux/kernel", "lm", "diag"]]
+    includes = ["-I./../{}".format(d) for d in ["unix", "generic", "tcl_dbg", "include", "lm/include"]]
+    includes += ["-I/usr/src/kernels/3.10.0-957.27.2.el7.x86_64/include/{}".format(d) for d in ["linux", "uapi", "asm"]]
+    defines = ["-DCHIP_CFG=TH_A", "-D__KERNEL__", "-DMODULE", "-DNXT_CORE_FW", "-DBRCM_PRIMATE_MODS=1"]
+    with open(path, "w") as f:
+        for n in range(nlines):
+            kind = rnd.random()
+            if kind < 0.05:
+                f.write("make[2]: Entering directory `{}'\n".format(rnd.choice(dirs)))
+            elif kind < 0.05 + compile_share:
+                f.write("gcc -c -fPIC -MMD -g {} {} ./../generic/file{}.c -o obj/file{}.o\n".format(
+                    " ".join(rnd.sample(includes, 5)), " ".join(rnd.sample(defines, 3)), n % 500, n % 500))
+            else:
+                f.write("../generic/file{}.c:{}:9: warning: unused variable 'x{}'\n".format(n % 500, n % 900, n))
+
+
+def generate_firmware_log(path: str, nlines: int, seed: int, compiler: str, compile_share: float) -> None:
+    rnd = random.Random(seed)
+    dirs = ["/git/int_nxt/main/Cumulus/firmware/{}".format(d) for d in ["THOR", "APE_VIEW/THOR", "BONO/THOR"]]
+    includes = ['-I "../RTOS/Nucleus_3/os/include"', "-I../../common/include", "-I ../core/include"]
+    includes += ["-I../../common/include/{}".format(n) for n in range(20)]
+    defines = ["-DUSING_MGC", "-DNXT_CORE_FW", "-DTARGET_NUCLEUS", "-DNITRO_NUCLEUS_VERSION=3", "-DLP64",
+               "-D BRCM_PRIMATE_MODS=1"] + ["-DFEATURE_{}=1".format(n) for n in range(30)]
+    # Paths the thor and cmba fixup rules pick a prefix for.
+    variants = ["../core", "../core", "../core", "-Ibsp/primate_r8_thor/include ../bsp", "../bc1/src",
+                "../core/roce_tlv", "obj_ARM/chdmpfw/../../chdmpfw"]
+    with open(path, "w") as f:
+        for n in range(nlines):
+            kind = rnd.random()
+            if kind < 0.05:
+                f.write("make[2]: Entering directory `{}'\n".format(rnd.choice(dirs)))
+            elif kind < 0.05 + compile_share:
+                source = "{}/module{}/file{}.c".format(rnd.choice(variants), n % 37, n % 700)
+                file_define = '-D__FILE__="Cumulus/firmware/{}"'.format(source.split()[-1][3:])
+                if rnd.random() < 0.5:
+                    file_define = "'{}'".format(file_define)
+                f.write("{} {} {} {} -mcpu=cortex-r7 -Og -g3 -oobj/file{}.o -c {} -Werror\n".format(
+                    compiler, " ".join(rnd.sample(includes, 8)), " ".join(rnd.sample(defines, 12)), file_define,
+                    n % 700, source))
+            elif kind < 0.15 + compile_share:
+                f.write("{}:{}:9: warning: unused variable 'x{}'\n".format(rnd.choice(variants), n % 900, n))
+            else:
+                f.write("[{:5}] CC obj/file{}.o\n".format(n, n % 700))
+
+
+def make_args(buildfile: str, outdir: str) -> Namespace:
+    args = cmaker.create_parser().parse_args(["-p", "bnxt-mt", "-o", outdir, "-b",
+                                              "/git/int_nxt/main/Cumulus/util/bnxt-mt/build", buildfile])
+    cmaker.validate_args(args)
+    return args
+
+
+def time_parse(args) -> float:
+    """
+    Time parsing args.buildfile with the line reader, which the trace always uses, so that a quiet
+    run and a traced run only differ in the logging.
+    """
+    parser = cmaker.BuildParser(args)
+    cmaker.cached_rel_path.cache_clear()
+    start = time.perf_counter()
+    parser.parse_lines(open(args.buildfile))
+    return time.perf_counter() - start
+
+
+def bench_logging(nlines: int, tmpdir: str) -> None:
+    """
+    Compare parsing with the quiet default against parsing with the debug trace file, which
+    every run paid for before the trace was made opt-in.
+    """
+    buildfile = os.path.join(tmpdir, "build.txt")
+    generate_log(buildfile, nlines)
+    args = make_args(buildfile, tmpdir)
+
+    cmaker.debug(logging.WARNING, logging.DEBUG)
+    quiet = time_parse(args)
+
+    cmaker.logfile(os.path.join(tmpdir, "cmaker.txt"))
+    cmaker.debug(logging.WARNING, logging.DEBUG)
+    trace = time_parse(args)
+
+    print("{} lines".format(nlines))
+    print("quiet: {:8.3f}s {:10.0f} lines/sec".format(quiet, nlines / quiet))
+    print("trace: {:8.3f}s {:10.0f} lines/sec".format(trace, nlines / trace))
+    print("speedup: {:.1f}x".format(trace / quiet))
+
+
+def bench_reader(nlines: int, tmpdir: str) -> None:
+    """
+    Compare the line by line reader against the block reader, which only decodes the candidate lines,
+    on a log with the usual share of compile lines and on a log that is mostly noise.
+    """
+    buildfile = os.path.join(tmpdir, "build.txt")
+    cmaker.debug(logging.WARNING, logging.WARNING)
+    print("{} lines".format(nlines))
+    for name, compile_share in [("usual", 0.3), ("noisy", 0.03)]:
+        generate_log(buildfile, nlines, compile_share=compile_share)
+        args = make_args(buildfile, tmpdir)
+        times = {}
+        for reader in ["lines", "blocks"]:
+            parser = cmaker.BuildParser(args)
+            cmaker.cached_rel_path.cache_clear()
+            start = time.perf_counter()
+            if reader == "lines":
+                parser.parse_lines(open(buildfile))
+            else:
+                parser.parse_blocks(open(buildfile, "rb"), "utf-8")
+            times[reader] = time.perf_counter() - start
+        print("{}: lines {:8.3f}s blocks {:8.3f}s speedup: {:.2f}x".format(
+            name, times["lines"], times["blocks"], times["lines"] / times["blocks"]))
+
+
+def run_case(sysargs: list) -> dict:
+    """
+    Run parse_build with the cmaker options sysargs and return its speed, peak RSS and output digest.
+
+    Each case runs in a fresh process so the peak RSS is its own.
+    """
+    args = cmaker.create_parser().parse_args(sysargs)
+    cmaker.validate_args(args)
+    cmaker.debug(logging.WARNING, logging.WARNING)
+    start = time.perf_counter()
+    result = cmaker.parse_build(args)
+    elapsed = time.perf_counter() - start
+    with open(os.path.join(args.outdir, "CMakeLists.txt"), "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return {"seconds": round(elapsed, 3), "lines_per_sec": round(result.nlines / elapsed),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "digest": digest}
+
+
+def send_result(conn, func, args: tuple) -> None:
+    conn.send(func(*args))
+    conn.close()
+
+
+def run_isolated(func, *args):
+    """
+    Return func(*args) run in a fresh process, which may start processes of its own.
+
+    func has to be importable by the fresh process. The bcmaker benchmarks use this too.
+    """
+    context = multiprocessing.get_context("spawn")
+    recv_conn, send_conn = context.Pipe(duplex=False)
+    process = context.Process(target=send_result, args=(send_conn, func, args))
+    process.start()
+    send_conn.close()
+    try:
+        return recv_conn.recv()
+    finally:
+        process.join()
+
+
+def bench_throughput(sizes: list, tmpdir: str) -> dict:
+    """
+    Measure parse_build on generated logs of every compiler and size in every mode.
+
+    The output of the serial, jobs and cache modes has to be the same.
+    """
+    cases = {}
+    for compiler, (platform, blddir) in compilers.items():
+        for nlines in sizes:
+            buildfile = os.path.join(tmpdir, "build.{}.{}.txt".format(compiler, nlines))
+            generate_log(buildfile, nlines, compiler=compiler)
+            for mode, (options, equivalent) in modes.items():
+                name = "{}/{}/{}".format(compiler, nlines, mode)
+                # Every case has its own output and cache dir so no case starts warm from another.
+                outdir = os.path.join(tmpdir, name)
+                os.makedirs(outdir)
+                sysargs = ["-p", platform, "-b", blddir, "-o", outdir, "--cache-dir", outdir] + options + [buildfile]
+                case = run_isolated(run_case, sysargs)
+                cases[name] = case
+                serial = cases["{}/{}/serial".format(compiler, nlines)]
+                same = case["digest"] == serial["digest"] or not equivalent
+                print("{:40} {:10} lines/sec {:8} KiB{}".format(
+                    name, case["lines_per_sec"], case["peak_rss_kb"], "" if same else "  OUTPUT DIFFERS FROM SERIAL"))
+            os.remove(buildfile)
+    return cases
+
+
+def compare_baseline(cases: dict, baseline: dict, rate: str = "lines_per_sec") -> bool:
+    """
+    Print the speed and peak RSS of the cases relative to a saved baseline and return False if
+    any output changed.
+
+    rate is the key of the speed in the cases. The bcmaker benchmarks use this too.
+    """
+    same = True
+    width = max(map(len, cases), default=0)
+    for name, case in cases.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        changed = case["digest"] != base["digest"]
+        same = same and not changed
+        print("{:{}} speed {:5.2f}x  rss {:5.2f}x{}".format(
+            name, width, case[rate] / base[rate], case["peak_rss_kb"] / base["peak_rss_kb"],
+            "  OUTPUT CHANGED" if changed else ""))
+    return same
+
+
+def time_commands(commands: dict, cwd: str, nruns: int) -> None:
+    """
+    Print the median and minimum time of nruns runs of each command. The bcmaker benchmarks use this too.
+    """
+    for name, command in commands.items():
+        times = []
+        for _ in range(nruns):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        print("{:6}: {:8.1f}ms median {:8.1f}ms min".format(name, statistics.median(times) * 1000, min(times) * 1000))
+
+
+def bench_startup(nruns: int, tmpdir: str) -> None:
+    """
+    Measure how long a cmaker process takes to start, for the batch jobs that run it thousands of times.
+
+    The python case is the interpreter alone, the floor of the others.
+    """
+    buildfile = os.path.join(tmpdir, "build.txt")
+    generate_log(buildfile, 100)
+    platform, blddir = compilers["gcc"]
+    script = cmaker.__file__
+    commands = {
+        "python": [sys.executable, "-c", "pass"],
+        "import": [sys.executable, "-c", "import cmaker.cmaker"],
+        "help": [sys.executable, script, "-h"],
+        "run": [sys.executable, script, "-p", platform, "-b", blddir, "-o", tmpdir, buildfile],
+    }
+    time_commands(commands, os.path.dirname(os.path.dirname(script)), nruns)
+
+
+def main(sysargs):
+    parser = ArgumentParser(prog="python -m cmaker.bench", description="cmaker benchmarks")
+    parser.add_argument("bench", choices=["logging", "reader", "throughput", "startup"], help="the benchmark to run")
+    parser.add_argument("--lines", default="1000000",
+                        help="the number of log lines, a comma separated list for throughput. Default: 1000000")
+    parser.add_argument("--baseline", help="compare the throughput results to this saved baseline")
+    parser.add_argument("--save-baseline", help="save the throughput results as a baseline to this file")
+    parser.add_argument("--runs", type=int, default=20, help="the number of runs of each startup case. Default: 20")
+    pargs = parser.parse_args(sysargs)
+    sizes = [int(size) for size in pargs.lines.split(",")]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if pargs.bench == "logging":
+            bench_logging(sizes[0], tmpdir)
+        elif pargs.bench == "reader":
+            bench_reader(sizes[0], tmpdir)
+        elif pargs.bench == "startup":
+            bench_startup(pargs.runs, tmpdir)
+        elif pargs.bench == "throughput":
+            cases = bench_throughput(sizes, tmpdir)
+            if pargs.save_baseline:
+                with open(pargs.save_baseline, "w") as f:
+                    json.dump(cases, f, indent=2, sort_keys=True)
+            if pargs.baseline:
+                with open(pargs.baseline) as f:
+                    if not compare_baseline(cases, json.load(f)):
+                        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
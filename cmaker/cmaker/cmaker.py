@@ -2,51 +2,108 @@
 Need to handle '-D__FILE__="Cumulus/firmware/core/qos_profiles/thor_1p.c"' lines
 """
 
+import codecs
+import contextlib
+import functools
+import io
+import json
 import logging
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 import os
 import re
+import sys
+import threading
+import time
+import types
 from enum import Enum
+from typing import Mapping, NamedTuple, Optional
 
+# Modules only some runs need, like multiprocessing, sqlite3, hashlib and the decompressors, are
+# imported where they are used, so starting the tool stays cheap.
 logger = logging.getLogger(__name__)
 formatter = logging.Formatter('%(asctime)s | %(levelname).3s | %(name)-20s | %(lineno)04d | %(message)s')
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-logfname = "/tmp/cmaker.txt"
-fh = logging.FileHandler(logfname, "w")
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-logger.addHandler(fh)
-logger.setLevel(min([ch.level, fh.level]))
-currline = 0
+# The console handler is added when the tool runs, see console(), so importing cmaker leaves logging alone.
+ch = None
+# The debug trace file is opt-in with --logfile, see logfile().
+logfname = None
+fh = None
+
+
+class LineFilter(logging.Filter):
+    """
+    Prefix log messages with the number of the build output line being processed.
+
+    Filters only run for records that pass the level check, so this costs nothing when debug
+    logging is off. lineno is only kept up to date while tracing, and per thread so parsers
+    running in threads each prefix their own line.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    @property
+    def lineno(self) -> int:
+        return getattr(self.local, "lineno", 0)
+
+    @lineno.setter
+    def lineno(self, value: int) -> None:
+        self.local.lineno = value
+
+    def filter(self, record):
+        record.msg = "[%05d] %s" % (self.lineno, record.msg)
+        return True
+
+
+linefilter = LineFilter()
+logger.addFilter(linefilter)
+
+
+def console() -> logging.Handler:
+    """
+    Return the handler that logs to stderr, adding it to the logger the first time.
+    """
+    global ch
+    if ch is None:
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+    return ch
 
 
 def debug(ch_level=logging.INFO, fh_level=logging.DEBUG):
-    ch.setLevel(ch_level)
-    ch.setLevel(fh_level)
-    logger.setLevel(min(ch_level, fh_level))
+    console().setLevel(ch_level)
+    if fh:
+        fh.setLevel(fh_level)
+        logger.setLevel(min(ch_level, fh_level))
+    else:
+        logger.setLevel(ch_level)
 
 
 def logfile(path: str):
+    """
+    Write a debug trace of the parsing to path.
+    """
     global fh
     global logfname
-    logger.removeHandler(fh)
-    fh.close()
+    if fh:
+        logger.removeHandler(fh)
+        fh.close()
     logfname = path
     fh = logging.FileHandler(path, "w")
     fh.setLevel(logging.DEBUG)
     fh.setFormatter(formatter)
     logger.addHandler(fh)
+    logger.setLevel(min(console().level, fh.level))
 
 
-class CustomAdapter(logging.LoggerAdapter):
-    def process(self, msg, kwargs):
-        return "[%05d] %s" % (currline, msg), kwargs
-
+def tracing() -> bool:
+    """
+    Return True if debug messages are logged, so hot loops can skip the per-line logging otherwise.
+    """
+    return logger.isEnabledFor(logging.DEBUG)
 
-loggerl = CustomAdapter(logger, {'currline': currline})
 
 cmake_template = '''
 cmake_minimum_required(VERSION 3.14)
@@ -65,19 +122,33 @@ add_executable({}
 )
 '''
 
+cmake_group_header_template = '''
+cmake_minimum_required(VERSION 3.14)
+project({})
+'''
+
+cmake_group_template = '''{}({} PRIVATE
+  {}
+)
+'''
 
-mkdir = "."
 blddir = ""
 re_mkdir = re.compile(r"^make.* Entering directory `(\S*)'")  # group is the directory after Entering directory
 re_cc = re.compile(r"^\s*(gcc|gcc|arm-none-eabi-gcc|armcc)")  # return the line if a compiler call is found
 re_def = re.compile(r" -D(\S*)")  # return definitions after -D. Some defines are dropped.
 re_inc = re.compile(r"-I\s*(\S*)|-I(\S*)")  # return includes after -I
 re_src = re.compile(r"\s*(gcc|armcc).*\s(\S*\.c)")  # return source files found in gcc lines
+re_token = re.compile(r"""(?:[^\s"']+|"[^"]*"|'[^']*'|["'])+""")  # argv tokens, quoted parts stay in the token
+re_quoted = re.compile(r"""(?:[^"']|"[^"]*"|'[^']*')*""")  # a token whose quotes all close inside it
+# The newline before a line that may be a compiler call or an Entering directory line, for the block reader.
+# Bytes past ASCII may be whitespace once decoded, so they may come before the compiler name.
+re_candidate = re.compile(rb"\n(?:[ \t\f\v\x1c-\x1f\x80-\xff]*(?:gcc|arm-none-eabi-gcc|armcc)"
+                          rb"|make[^\n]*Entering directory)")
+# Encodings in which ASCII bytes only ever stand for ASCII characters, which the block reader needs.
+ascii_encodings = {"ascii", "utf-8", "iso8859-1", "cp1252"}
 cwd = os.getcwd()
-
-defines = set([])
-includes = set([])
-sources = set([])
+path_cache_size = 8192
+read_block_size = 1 << 20
 
 
 class ParseStatus(Enum):
@@ -93,6 +164,25 @@ class ParseStatus(Enum):
     MORE = 3
 
 
+class BuildResult(NamedTuple):
+    """
+    The values extracted from a build output.
+
+    The sets are frozen and their strings interned, so results can be kept and shared between
+    threads. units maps every source to its (group, defines, includes) when sources are grouped
+    into targets, otherwise it is None.
+    """
+    defines: frozenset
+    includes: frozenset
+    sources: frozenset
+    units: Optional[Mapping]
+    nlines: int
+
+
+def freeze(values) -> frozenset:
+    return frozenset(map(sys.intern, values))
+
+
 def get_prefix_value(value: str, prefix: str, strip: str):
     """
 
@@ -102,84 +192,46 @@ def get_prefix_value(value: str, prefix: str, strip: str):
         pvalue = pvalue[len(strip):]
     elif prefix != "" and not pvalue.startswith("/"):
         pvalue = (prefix + "/" + pvalue)
-    loggerl.debug("pvalue: {}".format(pvalue))
+    logger.debug("pvalue: %s", pvalue)
     return pvalue
 
 
 def get_rel_path(blddir, prefix):
-    norm_prefix_path = os.path.normpath(prefix)
+    # Paths on a compile line are relative to the dir the compiler ran in, not to our cwd.
+    norm_prefix_path = os.path.normpath(os.path.join(blddir, prefix))
     rel_path = os.path.relpath(norm_prefix_path, blddir)
-    loggerl.debug("add: {}".format(rel_path))
+    logger.debug("add: %s", rel_path)
     return rel_path
 
 
-def extract_defines(line: str) -> None:
-    """
-    Extract defines of the form -Ddefinition.
+@functools.lru_cache(maxsize=path_cache_size)
+def cached_rel_path(value: str, prefix: str, blddir: str) -> str:
     """
-    # regex to get any -D defines.
-    for m in re_def.finditer(line):
-        if m.group(1):
-            match = m.group(1)
-            # drop "KBUILD_BASENAME=KBUILD_STR(um_gpio)" lines as cmake can't parse the ()
-            if "KBUILD" in match:
-                continue
-            if match.startswith('"') and match.endswith('"'):
-                pvalue = match.strip('"')
-            else:
-                pvalue = match
-            defines.add(pvalue)
-
+    Return the path of an include or source value relative to the build dir.
 
-def extract_includes(line: str, prefix: str, blddir: str) -> None:
+    Builds repeat the same include paths on thousands of compile lines, so the results are kept
+    in a bounded cache to skip the path arithmetic for values that were seen before.
     """
-    Extract includes of the forms -I includedir or -Iincludedir.
+    return get_rel_path(blddir, get_prefix_value(value, prefix, ""))
 
-    For the form, -I includedir, the value ParseStatus.MORE will be returned. The caller must
-    call again with the next token and ParseStatus.MORE to be extracted.
-    """
-    # regex to get any -I includes. Iterate over the includes list to add
-    # any path prefix, normalize the path and then get a relative path from the build dir.
-    for m in re_inc.finditer(line):
-        # group(1): -I /path, group(2): -I/path
-        group = m.group(1) if m.group(1) else m.group(2)
-        if group:
-            rel_path = get_rel_path(blddir, get_prefix_value(group, prefix, ""))
-            includes.add(rel_path)
-        else:
-            loggerl.warning("group(include) not found, m: {}, 1: {}, 2: {}".format(m.group(), m.group(1), m.group(2)))
 
-
-def extract_source(line: str, prefix: str, blddir: str) -> None:
-    """
-    Extract source files that end with .c.
-    """
-    # regex to get a .c file.
-    # Then add any path prefix, normalize the path and then get a relative path from the build dir.
-    m = re_src.search(line)
-    if m:
-        if m.group(2):
-            rel_path = get_rel_path(blddir, get_prefix_value(m.group(2), prefix, ""))
-            sources.add(rel_path)
-        else:
-            loggerl.warning("group(source) not found, m: {}, 1: {}, 2: {}".format(m.group(), m.group(1), m.group(2)))
+def log_cache_info() -> None:
+    info = cached_rel_path.cache_info()
+    logger.debug("path cache: hits: %d, misses: %d, size: %d/%d", info.hits, info.misses, info.currsize, info.maxsize)
 
 
-def extract_mkdir(line: str) -> None:
+def get_mkdir(line: str):
     """
-    Extract the Make directory lines by looking for Entering directory...
+    Return the directory of an Entering directory line, or None for any other line.
     """
-    global mkdir
     m = re_mkdir.search(line)
-    if m:
-        mkdir2 = m.group(1)
-        # /usr is in /git on the mac
-        if mkdir2.startswith("/usr"):
-            mkdir2 = "/git" + mkdir2
-
-        if mkdir != mkdir2:
-            loggerl.debug("mkdir: {}, previous: {}".format(mkdir2, mkdir))
-            mkdir = mkdir2
+    if not m:
+        return None
+    mkdir2 = m.group(1)
+    # /usr is in /git on the mac
+    if mkdir2.startswith("/usr"):
+        mkdir2 = "/git" + mkdir2
+    return mkdir2
 
 
 def extract_cc(line: str) -> bool:
@@ -192,58 +244,746 @@ def extract_cc(line: str) -> bool:
     return False
 
 
-def process_line(args, line: str) -> None:
+class BuildParser:
     """
-    Process each line and extra the wanted values.
+    Extract the defines, includes and sources of one build output.
 
-    The line is split into tokens that are space-delimited. Each token is parsed by different parsers
-    to extract the desired data.
+    All of the state of a parse lives in the parser, so parses of different platforms can run side
+    by side in threads or in a pool without seeing each other's values. Use a new parser for each
+    parse and call result() for what it found.
     """
 
-    # Get make directories if the make changes the cwd.
-    if line.startswith("make"):
-        extract_mkdir(line)
-        return
+    def __init__(self, args, mkdir: str = "."):
+        self.args = args
+        self.mkdir = mkdir
+        self.defines = set()
+        self.includes = set()
+        self.sources = set()
+        self.compdb = None
+        # source -> (group, defines, includes) when grouping sources into targets
+        self.units = {} if getattr(args, "group_by", "none") != "none" else None
+        self.nlines = 0
+        self.fixups = platform_fixups(args)
+
+    def extract_defines(self, line: str) -> None:
+        """
+        Extract defines of the form -Ddefinition.
+        """
+        # regex to get any -D defines.
+        for m in re_def.finditer(line):
+            if m.group(1):
+                match = m.group(1)
+                # drop "KBUILD_BASENAME=KBUILD_STR(um_gpio)" lines as cmake can't parse the ()
+                if "KBUILD" in match:
+                    continue
+                if match.startswith('"') and match.endswith('"'):
+                    pvalue = match.strip('"')
+                else:
+                    pvalue = match
+                self.defines.add(pvalue)
+
+    def extract_includes(self, line: str, prefix: str, blddir: str) -> None:
+        """
+        Extract includes of the forms -I includedir or -Iincludedir.
+        """
+        # regex to get any -I includes. Iterate over the includes list to add
+        # any path prefix, normalize the path and then get a relative path from the build dir.
+        for m in re_inc.finditer(line):
+            # group(1): -I /path, group(2): -I/path
+            group = m.group(1) if m.group(1) else m.group(2)
+            if group:
+                rel_path = cached_rel_path(group, prefix, blddir)
+                self.includes.add(rel_path)
+            else:
+                logger.warning("group(include) not found, m: %s, 1: %s, 2: %s", m.group(), m.group(1), m.group(2))
+
+    def extract_source(self, line: str, prefix: str, blddir: str):
+        """
+        Extract source files that end with .c and return the source as found on the line, or None.
+        """
+        # regex to get a .c file.
+        # Then add any path prefix, normalize the path and then get a relative path from the build dir.
+        m = re_src.search(line)
+        if m:
+            if m.group(2):
+                rel_path = cached_rel_path(m.group(2), prefix, blddir)
+                self.sources.add(rel_path)
+                return m.group(2)
+            else:
+                logger.warning("group(source) not found, m: %s, 1: %s, 2: %s", m.group(), m.group(1), m.group(2))
+        return None
+
+    def extract_tokens(self, line: str, inc_prefix: str, src_prefix: str, blddir: str):
+        """
+        Extract defines, includes and the source file in a single sweep over the argv tokens of a compile line.
+
+        Tokens are split like a shell would split them but keep their quotes, so -D__FILE__="a b.c"
+        is one token and the value is the same as the one extract_defines finds. -D and -I take their
+        value from the next token when it is separate, so -D NAME is found too, which the regex path
+        misses. The last token ending with .c is the source, which is returned as found on the line,
+        or None.
+
+        Most lines have no whitespace inside quotes, so they are split with str.split() and only
+        split with re_token when a quote doesn't close inside its token.
+        """
+        source = None
+        tokens = line.split()
+        if '"' in line or "'" in line:
+            for token in tokens:
+                if ('"' in token or "'" in token) and not re_quoted.fullmatch(token):
+                    tokens = re_token.findall(line)
+                    break
+        defines = self.defines
+        includes = self.includes
+        tokens = iter(tokens)
+        for token in tokens:
+            if token[0] != "-":
+                if token.endswith((".c", '.c"')):
+                    source = token
+                continue
+            flag = token[1:2]
+            if flag == "D":
+                value = token[2:] or next(tokens, "")
+                # drop "KBUILD_BASENAME=KBUILD_STR(um_gpio)" lines as cmake can't parse the ()
+                if not value or "KBUILD" in value:
+                    continue
+                if value[0] == '"' and value[-1] == '"':
+                    value = value.strip('"')
+                defines.add(value)
+            elif flag == "I":
+                value = token[2:] or next(tokens, "")
+                if value:
+                    includes.add(cached_rel_path(value, inc_prefix, blddir))
+
+        if source:
+            self.sources.add(cached_rel_path(source, src_prefix, blddir))
+        return source
+
+    def extract_mkdir(self, line: str) -> None:
+        """
+        Extract the Make directory lines by looking for Entering directory...
+        """
+        mkdir2 = get_mkdir(line)
+        if mkdir2:
+            if self.mkdir != mkdir2:
+                logger.debug("mkdir: %s, previous: %s", mkdir2, self.mkdir)
+                self.mkdir = mkdir2
+
+    def process_line(self, line: str) -> None:
+        """
+        Process each line and extra the wanted values.
+
+        The line is split into tokens that are space-delimited. Each token is parsed by different parsers
+        to extract the desired data.
+        """
+
+        # Get make directories if the make changes the cwd.
+        if line.startswith("make"):
+            self.extract_mkdir(line)
+            return
+
+        # Only process compile lines.
+        if not extract_cc(line):
+            return
+
+        if self.units is None:
+            self.extract_compile_line(line)
+            return
+
+        line_defines, line_includes, line_sources = self.extract_line(line)
+        self.defines.update(line_defines)
+        self.includes.update(line_includes)
+        self.sources.update(line_sources)
+        if line_sources:
+            group = self.get_group(line, line_defines, line_includes)
+            for source in line_sources:
+                unit = self.units.get(source)
+                self.units[source] = (group, line_defines | unit[1], line_includes | unit[2]) if unit else \
+                    (group, line_defines, line_includes)
+
+    def extract_compile_line(self, line: str) -> None:
+        """
+        Extract the wanted values of a compile line into the defines, includes and sources.
+        """
+        args = self.args
+        prefix = self.get_prefix(line)
+        if getattr(args, "legacy_regex", False):
+            self.extract_defines(line)
+            self.extract_includes(line, prefix, args.blddir)
+            source = self.extract_source(line, prefix, args.blddir)
+        else:
+            source = self.extract_tokens(line, prefix, prefix, args.blddir)
+
+        if self.compdb is not None and source:
+            self.compdb.add(line, source, prefix, args.blddir)
+
+    def extract_line(self, line: str) -> tuple:
+        """
+        Extract the values of a compile line on its own and return the defines, includes and sources found in it.
+        """
+        saved = self.defines, self.includes, self.sources
+        self.defines, self.includes, self.sources = set(), set(), set()
+        try:
+            self.extract_compile_line(line)
+            return self.defines, self.includes, self.sources
+        finally:
+            self.defines, self.includes, self.sources = saved
+
+    def get_prefix(self, line: str) -> str:
+        return self.fixups.get_prefix(line, self.mkdir, self.args.blddir)
+
+    def get_group(self, line: str, line_defines: set, line_includes: set):
+        """
+        Return the key of the group a compile line belongs to when sources are grouped into targets.
+
+        flags: sources built with identical defines and includes share a target. The __FILE__
+        define differs for every source, so it is left out, as bcmaker does.
+        dir: sources built from the same directory share a target. The directory is the prefix
+        the fixup rules give for the line, or the make directory.
+        """
+        if self.args.group_by == "flags":
+            return (tuple(sorted(define for define in line_defines if not define.startswith("__FILE__"))),
+                    tuple(sorted(line_includes)))
+        return self.get_prefix(line) or self.mkdir
+
+    def start_compile_commands(self) -> None:
+        """
+        Start streaming compile_commands.json to the output dir if it was asked for.
+        """
+        if getattr(self.args, "compile_commands", False):
+            self.compdb = CompileCommandsWriter(self.args.outdir + "/compile_commands.json")
+
+    def finish_compile_commands(self) -> None:
+        if self.compdb is not None:
+            self.compdb.close()
+            self.compdb = None
+
+    def abort_compile_commands(self) -> None:
+        if self.compdb is not None:
+            self.compdb.abort()
+            self.compdb = None
+
+    def parse(self) -> BuildResult:
+        """
+        Parse the build output file of the args and return the result.
+        """
+        args = self.args
+        self.start_compile_commands()
+        start = time.perf_counter()
+        try:
+            if self.compdb is not None or self.units is not None or getattr(args, "profile", False):
+                # Each compile line has to be seen in order to stream its entry, to keep its flags or to time it.
+                if getattr(args, "jobs", 1) != 1 or getattr(args, "cache", False):
+                    logger.warning("--compile-commands, --group-by and --profile parse serially without the cache")
+                nlines = self.parse_log(open_log(args.buildfile, binary=True))
+            elif getattr(args, "jobs", 1) != 1 and log_codec(args.buildfile):
+                logger.warning("{} is compressed and is parsed serially".format(args.buildfile))
+                nlines = self.parse_log(open_log(args.buildfile, binary=True))
+            elif getattr(args, "jobs", 1) != 1:
+                nlines = self.parse_parallel()
+            elif getattr(args, "cache", False):
+                nlines = self.parse_cached()
+            else:
+                nlines = self.parse_log(open_log(args.buildfile, binary=True))
+        except BaseException:
+            self.abort_compile_commands()
+            raise
+        self.finish_compile_commands()
+        self.nlines = nlines
+        elapsed = time.perf_counter() - start
+        logger.info("Parsed {} lines in {:.3f}s, {:.0f} lines/sec ({})".format(
+            nlines, elapsed, nlines / elapsed if elapsed else 0,
+            "regex" if getattr(args, "legacy_regex", False) else "tokenizer"))
+        log_cache_info()
+        return self.result()
+
+    def parse_lines(self, f, start_line: int = 0) -> int:
+        """
+        Process every line of f and return the number of lines, closing f when done.
+
+        start_line is the number of lines before f, which only matters for the debug trace.
+        """
+        nlines = 0
+        with f:
+            if not tracing():
+                for nlines, line in enumerate(f, 1):
+                    self.process_line(line)
+                return nlines
+            for nlines, line in enumerate(f, 1):
+                linefilter.lineno = start_line + nlines
+                logger.debug("Processing line %d: %s", linefilter.lineno, line)
+                self.process_line(line)
+        return nlines
+
+    def parse_log(self, f, start_line: int = 0) -> int:
+        """
+        Process the lines of the binary file f and return the number of lines, closing f when done.
+
+        The lines are decoded the way open() decodes them. Unless every line has to be traced, the
+        block reader skips the lines that can't be compile or make directory lines without decoding them.
+        """
+        import locale
+        encoding = locale.getpreferredencoding(False)
+        if tracing() or codecs.lookup(encoding).name not in ascii_encodings:
+            return self.parse_lines(io.TextIOWrapper(f, encoding), start_line)
+        return self.parse_blocks(f, encoding)
+
+    def parse_blocks(self, f, encoding: str, block_size: int = 0) -> int:
+        """
+        Process the candidate lines of the binary file f, read in blocks, and return the number of lines.
+
+        Blocks are read into one reused buffer and cut after their last newline, the rest is carried
+        over to the next block. re_candidate finds the lines that may be compiler calls or make directory
+        changes and only those are decoded and processed, the other lines are only counted. A block with
+        a carriage return, which also ends a line in text mode, is decoded and processed line by line.
+        """
+        buf = bytearray(block_size or read_block_size)
+        # A newline before the first line, so that re_candidate finds it like any other.
+        buf[0] = 10
+        filled = 1
+        nlines = 0
+        with f:
+            while True:
+                n = f.readinto(memoryview(buf)[filled:])
+                end = filled + n
+                if n:
+                    last = buf.rfind(b"\n", 1, end) + 1
+                    if not last:
+                        # No complete line yet, grow the buffer if the line doesn't fit.
+                        if end == len(buf):
+                            buf.extend(bytes(len(buf)))
+                        filled = end
+                        continue
+                elif end == 1:
+                    break
+                else:
+                    last = end
+                if buf.find(b"\r", 1, last) >= 0:
+                    for line in io.StringIO(buf[1:last].decode(encoding), newline=None):
+                        nlines += 1
+                        self.process_line(line)
+                else:
+                    # At the end of the file the last line may not end with a newline.
+                    nlines += buf.count(b"\n", 1, last) + (not n)
+                    for m in re_candidate.finditer(buf, 0, last):
+                        stop = buf.find(b"\n", m.end(), last) + 1 or last
+                        self.process_line(buf[m.start() + 1:stop].decode(encoding))
+                if not n:
+                    break
+                buf[1:1 + end - last] = buf[last:end]
+                filled = 1 + end - last
+        return nlines
+
+    def parse_parallel(self, chunk_size: int = 0) -> int:
+        """
+        Parse the build output file in chunks with a process pool, merge the results and return the number of lines.
+
+        The first pass counts the lines and finds the last make directory of every chunk so that the
+        second pass can start each chunk with the make directory carried over from the chunks before it.
+        """
+        args = self.args
+        nlines = 0
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        if not chunk_size:
+            # Several chunks per worker to balance the load, but not so small that the pool overhead wins.
+            chunk_size = max(os.path.getsize(args.buildfile) // (jobs * 4) + 1, 1 << 20)
+        chunks = split_chunks(args.buildfile, chunk_size)
+        logger.info("Parsing {} chunks with {} jobs".format(len(chunks), jobs))
+
+        import multiprocessing
+        with multiprocessing.Pool(jobs) as pool:
+            scans = pool.starmap(scan_chunk, [(args.buildfile, start, end) for start, end in chunks])
+            tasks = []
+            for (start, end), (chunk_lines, last_mkdir) in zip(chunks, scans):
+                tasks.append((args, args.buildfile, start, end, nlines, self.mkdir))
+                nlines += chunk_lines
+                self.mkdir = last_mkdir or self.mkdir
+            results = pool.starmap(parse_chunk, tasks)
+
+        for chunk_defines, chunk_includes, chunk_sources in results:
+            self.defines.update(chunk_defines)
+            self.includes.update(chunk_includes)
+            self.sources.update(chunk_sources)
+        return nlines
+
+    def parse_cached(self) -> int:
+        """
+        Parse the build output file using the on-disk cache and return the number of lines parsed.
+
+        If the log starts with the bytes parsed last time, only the appended part is parsed. Otherwise
+        the log is read again, but compile lines seen before take their values from the cache.
+        """
+        import hashlib
+        import locale
+        args = self.args
+        cache = ParseCache(ParseCache.location(args))
+        path = os.path.abspath(args.buildfile)
+        encoding = locale.getpreferredencoding(False)
+        # Lines and logs parsed with other fixup rules get other values, so the rules are part of the keys.
+        mode = ("regex" if getattr(args, "legacy_regex", False) else "tokenizer") + self.fixups.key
+        targets = [self.defines, self.includes, self.sources]
+        digest = hashlib.sha1()
+        start = 0
+        nlines = 0
+
+        # The offsets of a compressed log are in the decompressed data, whose size isn't known up front.
+        size = None if log_codec(path) else os.path.getsize(path)
+        f = open_log(path, binary=True)
+        try:
+            entry = cache.get_log(path, mode)
+            if entry and (size is None or entry[0] <= size):
+                offset, log_digest = entry[0], entry[1]
+                prefix = hashlib.sha1()
+                remaining = offset
+                while remaining:
+                    data = f.read(min(1 << 20, remaining))
+                    if not data:
+                        # The log is shorter than the part parsed last time, so it was replaced.
+                        break
+                    prefix.update(data)
+                    remaining -= len(data)
+                if not remaining and prefix.digest() == log_digest:
+                    logger.info("Resuming {} from offset {}".format(args.buildfile, offset))
+                    start = offset
+                    digest = prefix
+                    self.mkdir = entry[2]
+                    for values, target in zip(entry[3:], targets):
+                        target.update(values.split("\n") if values else [])
+                else:
+                    # Compressed streams can't always seek back, so the log is opened again.
+                    f.close()
+                    f = open_log(path, binary=True)
+
+            state = None
+            offset = start
+            for raw in f:
+                nlines += 1
+                if not raw.endswith(b"\n"):
+                    # A partial last line of a log that is still being written is parsed, but not
+                    # remembered, so the next run parses it again when it is complete.
+                    state = (self.mkdir, set(self.defines), set(self.includes), set(self.sources))
+                else:
+                    digest.update(raw)
+                    offset += len(raw)
+                line = raw.decode(encoding)
+                if line.startswith("make"):
+                    self.extract_mkdir(line)
+                    continue
+                if not extract_cc(line):
+                    continue
+                key = hashlib.sha1("\0".join([mode, self.mkdir, line]).encode()).digest()
+                values = cache.get_line(key)
+                if values is None:
+                    values = self.extract_line(line)
+                    cache.put_line(key, *values)
+                for line_values, target in zip(values, targets):
+                    target.update(line_values)
+        finally:
+            f.close()
+
+        cache.put_log(path, mode, offset, digest.digest(), state or (self.mkdir, self.defines, self.includes, self.sources))
+        cache.close()
+        logger.info("Parse cache {}: hits: {}, misses: {}".format(cache.path, cache.hits, cache.misses))
+        return nlines
+
+    def result(self) -> BuildResult:
+        """
+        Return a frozen copy of the values found so far, with the platform extras added to the includes.
+        """
+        units = None
+        if self.units is not None:
+            units = types.MappingProxyType({
+                sys.intern(source): (group, freeze(unit_defines), freeze(unit_includes))
+                for source, (group, unit_defines, unit_includes) in self.units.items()})
+        return BuildResult(freeze(self.defines), freeze(self.includes | self.fixups.extra_includes),
+                           freeze(self.sources), units, self.nlines)
+
+
+class Profile:
+    """
+    Time spent in each phase of a run, and counters.
 
-    # Only process compile lines.
-    if not extract_cc(line):
-        return
+    Phases nest, and the time of a phase doesn't include the phases started inside it, so the
+    times add up to the time of the run. Time outside of every phase is reported as other.
+    """
+    phases = ["read", "classify", "fixups", "defines", "includes", "sources", "tokens", "render", "write"]
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(self.phases, 0.0)
+        self.counters = {}
+        self.stack = []
+        self.mark = 0.0
+        self.started = time.perf_counter()
+
+    def start(self, phase: str) -> None:
+        now = time.perf_counter()
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.mark
+        self.stack.append(phase)
+        self.mark = now
+
+    def stop(self) -> None:
+        now = time.perf_counter()
+        self.seconds[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    @contextlib.contextmanager
+    def phase(self, phase: str):
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def count(self, counter: str, n: int = 1) -> None:
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def report(self) -> list:
+        """
+        Return the lines of a table of the time of each phase, and of the counters.
+        """
+        total = time.perf_counter() - self.started
+        seconds = dict(self.seconds, other=max(total - sum(self.seconds.values()), 0.0))
+        lines = ["{:10} {:>10} {:>6}".format("phase", "seconds", "%")]
+        for phase, phase_seconds in seconds.items():
+            lines.append("{:10} {:10.3f} {:6.1f}".format(phase, phase_seconds, 100 * phase_seconds / total))
+        lines.append("{:10} {:10.3f}".format("total", total))
+        lines.append(", ".join("{}: {}".format(counter, n) for counter, n in self.counters.items()))
+        return lines
+
+
+class ProfiledBuildParser(BuildParser):
+    """
+    A BuildParser that times the phases of the parse in a Profile.
+
+    The tokenizer extracts the defines, includes and sources in a single sweep, so its time is
+    the tokens phase. With --legacy-regex each of them has its own phase.
+    """
 
-    inc_prefix, src_prefix, _ = get_fixups(args, line, mkdir)
-    extract_defines(line)
-    extract_includes(line, inc_prefix, args.blddir)
-    extract_source(line, src_prefix, args.blddir)
-
-
-def get_fixups(args, line: str, mkdir: str):
-    # Add a path prefix for lines where the path has changed due to different make calls.
-    strip = ""
-    inc_prefix = ""
-    src_prefix = ""
-
-    if args.platform == "thor" or args.platform == "cmba":
-        # These builds don't print the Entering directory string and run the build
-        # in parallel so it is difficult to get the prefixes matched up.
-        if "-Ibsp" in line:
-            inc_prefix = src_prefix = args.blddir + "/../RTOS/Nucleus_3"
-        elif "bc1" in line:
-            inc_prefix = src_prefix = args.blddir + "/../bc1"
-        elif "roce_tlv" in line:
-            if "APE" in mkdir or "BONO" in mkdir or "KONG" in mkdir:
-                inc_prefix = src_prefix = args.blddir + "/.."
+    def __init__(self, args, profile: Profile, mkdir: str = "."):
+        super().__init__(args, mkdir)
+        self.profile = profile
+
+    def parse_lines(self, f, start_line: int = 0) -> int:
+        profile = self.profile
+        nlines = 0
+        with f:
+            lines = iter(f)
+            while True:
+                profile.start("read")
+                line = next(lines, None)
+                profile.stop()
+                if line is None:
+                    break
+                nlines += 1
+                self.process_line(line)
+        profile.count("lines", nlines)
+        return nlines
+
+    def parse_blocks(self, f, encoding: str, block_size: int = 0) -> int:
+        # The phases of the candidate lines are timed inside, so read is the reading and the prefilter.
+        self.profile.start("read")
+        try:
+            nlines = super().parse_blocks(f, encoding, block_size)
+        finally:
+            self.profile.stop()
+        self.profile.count("lines", nlines)
+        return nlines
+
+    def process_line(self, line: str) -> None:
+        self.profile.start("classify")
+        try:
+            super().process_line(line)
+        finally:
+            self.profile.stop()
+
+    def extract_compile_line(self, line: str) -> None:
+        self.profile.count("compile lines")
+        super().extract_compile_line(line)
+
+    def get_prefix(self, line: str) -> str:
+        self.profile.start("fixups")
+        try:
+            return super().get_prefix(line)
+        finally:
+            self.profile.stop()
+
+    def extract_defines(self, line: str) -> None:
+        self.profile.start("defines")
+        try:
+            super().extract_defines(line)
+        finally:
+            self.profile.stop()
+
+    def extract_includes(self, line: str, prefix: str, blddir: str) -> None:
+        self.profile.start("includes")
+        try:
+            super().extract_includes(line, prefix, blddir)
+        finally:
+            self.profile.stop()
+
+    def extract_source(self, line: str, prefix: str, blddir: str):
+        self.profile.start("sources")
+        try:
+            return super().extract_source(line, prefix, blddir)
+        finally:
+            self.profile.stop()
+
+    def extract_tokens(self, line: str, inc_prefix: str, src_prefix: str, blddir: str):
+        self.profile.start("tokens")
+        try:
+            return super().extract_tokens(line, inc_prefix, src_prefix, blddir)
+        finally:
+            self.profile.stop()
+
+
+class CompileCommandsWriter:
+    """
+    Stream a compile_commands.json file with one entry per distinct compile line.
+
+    Entries are written as they are found instead of being kept in memory, only a digest of each
+    entry is kept to drop duplicates. The file is written to a temp file and renamed on close.
+    The directory of an entry is the prefix the fixup rules give for the line, or the build dir, since
+    that is where the relative paths on the line resolve.
+    """
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.tmpname = "{}.{}.{}.tmp".format(fname, os.getpid(), threading.get_ident())
+        self.f = open(self.tmpname, "w")
+        self.f.write("[")
+        self.seen = set()
+
+    def add(self, line: str, source: str, prefix: str, blddir: str) -> None:
+        import hashlib
+        entry = json.dumps({
+            "directory": os.path.abspath(prefix or blddir),
+            "command": line.strip(),
+            "file": source.strip('"'),
+        })
+        key = hashlib.sha1(entry.encode()).digest()
+        if key in self.seen:
+            return
+        self.f.write("\n  " if not self.seen else ",\n  ")
+        self.f.write(entry)
+        self.seen.add(key)
+
+    def close(self) -> None:
+        self.f.write("\n]\n")
+        self.f.close()
+        os.replace(self.tmpname, self.fname)
+        logger.info("{} has been written with {} entries".format(self.fname, len(self.seen)))
+
+    def abort(self) -> None:
+        """
+        Drop the temp file of a parse that failed, leaving any previous file alone.
+        """
+        self.f.close()
+        if os.path.exists(self.tmpname):
+            os.unlink(self.tmpname)
+
+
+default_fixups = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixups.json")
+fixup_keys = {"base", "rules", "default", "extra_includes"}
+rule_keys = {"match", "mkdir", "prefix"}
+
+
+class FixupRules:
+    """
+    The fixup rules of a platform: the path prefix of the values of a compile line and the extra includes.
+
+    Builds that don't print the Entering directory string, or that run in parallel, need a prefix
+    picked from what is on the compile line. Each rule has the strings to look for on the line, an
+    optional list of strings of which one must be in the make directory, and the prefix, where
+    {blddir} and {mkdir} are replaced. The first rule in order that applies wins, otherwise the
+    default prefix is used.
+
+    The rules that apply in a make directory, with their prefixes filled in, are worked out once
+    per make directory and build dir, so a compile line only costs the substring checks. Those
+    stay an ordered scan: a single alternation of all the strings can only report the leftmost
+    match, not the first rule in order, and on thor lines it is slower than the scan, about 7.6us
+    against 2.8us per line.
+    """
+
+    def __init__(self, rules: list = (), default: str = "", extra_includes: list = ()):
+        self.rules = []
+        for rule in rules:
+            unknown = set(rule) - rule_keys
+            if unknown or not rule.get("match") or "prefix" not in rule:
+                raise ValueError("invalid fixup rule {}".format(rule))
+            self.rules.append((tuple(rule["match"]), tuple(rule.get("mkdir", ())), rule["prefix"]))
+        self.default = default
+        self.extra_includes = set(extra_includes)
+        self.config = [rules, default]
+        self.resolved = {}  # (mkdir, blddir) -> what resolve returns
+
+    @functools.cached_property
+    def key(self) -> str:
+        """
+        A digest of the rules, for the cache to tell apart values parsed with other rules.
+        """
+        import hashlib
+        return hashlib.sha1(json.dumps(self.config, sort_keys=True).encode()).hexdigest()
+
+    def resolve(self, mkdir: str, blddir: str) -> tuple:
+        """
+        Return the (patterns, prefix) of the rules that apply in mkdir and the default prefix, with
+        {blddir} and {mkdir} replaced in the prefixes.
+        """
+        def fill(prefix: str) -> str:
+            return prefix.replace("{blddir}", blddir).replace("{mkdir}", mkdir) if prefix else prefix
+
+        rules = tuple((patterns, fill(rule_prefix)) for patterns, rule_mkdir, rule_prefix in self.rules
+                      if not rule_mkdir or any(value in mkdir for value in rule_mkdir))
+        resolved = self.resolved[mkdir, blddir] = rules, fill(self.default)
+        return resolved
+
+    def get_prefix(self, line: str, mkdir: str, blddir: str) -> str:
+        """
+        Return the prefix of the relative paths of a compile line, or "" if they are relative to blddir.
+        """
+        rules, prefix = self.resolved.get((mkdir, blddir)) or self.resolve(mkdir, blddir)
+        for patterns, rule_prefix in rules:
+            for pattern in patterns:
+                if pattern in line:
+                    break
             else:
-                inc_prefix = src_prefix = args.blddir
-        elif "obj_ARM/chdmpfw" in line:
-            inc_prefix = src_prefix = args.blddir + "/../chdmpfw"
-        elif "obj/cmb_a_afm" in line:
-            inc_prefix = src_prefix = args.blddir
-        elif "APE_VIEW" in line or "BONO" in line or "KONG_VIEW" in line:
-            inc_prefix = src_prefix = mkdir
-    elif args.platform == "bnxt-mt" or args.platform == "lcdiag" or args.platform == "bnxt_en":
-        inc_prefix = src_prefix = mkdir
+                continue
+            prefix = rule_prefix
+            break
+        logger.debug("prefix: %s", prefix)
+        return prefix
+
 
-    loggerl.debug("strip: {}, inc_prefix: {}, src_prefix: {}".format(strip, inc_prefix, src_prefix))
-    return inc_prefix, src_prefix, strip
+@functools.lru_cache(maxsize=None)
+def load_fixups(path: str) -> dict:
+    """
+    Return the FixupRules of every platform in a fixups file.
+
+    The file is a JSON object with an entry per platform with the keys rules, default and
+    extra_includes. A platform with base takes the rules and default of that platform unless it
+    has its own.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    fixups = {}
+    for platform, entry in config.items():
+        unknown = set(entry) - fixup_keys
+        if unknown:
+            raise ValueError("{}: {}: unknown keys {}".format(path, platform, ", ".join(sorted(unknown))))
+        base = config.get(entry["base"], {}) if "base" in entry else {}
+        fixups[platform] = FixupRules(entry.get("rules", base.get("rules", [])),
+                                      entry.get("default", base.get("default", "")),
+                                      entry.get("extra_includes", []))
+    return fixups
+
+
+def platform_fixups(args) -> FixupRules:
+    """
+    Return the fixup rules of the platform of args, no rules for a platform without any.
+    """
+    fixups = load_fixups(getattr(args, "fixups", None) or default_fixups)
+    return fixups.get(getattr(args, "platform", None)) or FixupRules()
 
 
 def makelststr(tokens: set) -> str:
@@ -256,57 +996,484 @@ def makelststr(tokens: set) -> str:
     return lststr
 
 
-def make_cmakelist(args):
+def make_grouped_cmakelist(name: str, groups: dict, common_defines: set, common_includes: set) -> str:
+    """
+    Render a CMakeLists.txt with an object library for each group of sources.
+
+    groups maps a group key to (sources, defines, includes). Each group gets its own definitions
+    and include directories so IDEs and CMake don't apply the union of all flags to every file.
+    Flags that don't belong to any source stay global.
+    """
+    output = cmake_group_header_template.format(name)
+    if common_defines:
+        output += "\nadd_compile_definitions(\n  {}\n)\n".format(makelststr(common_defines))
+    if common_includes:
+        output += "\ninclude_directories(\n  {}\n)\n".format(makelststr(common_includes))
+    targets = sorted(groups.values(), key=lambda group: sorted(group[0]))
+    for n, (group_sources, group_defines, group_includes) in enumerate(targets, 1):
+        target = "{}_{:03d}".format(name, n)
+        output += "\nadd_library({} OBJECT\n  {}\n)\n".format(target, makelststr(group_sources))
+        if group_defines:
+            output += cmake_group_template.format("target_compile_definitions", target, makelststr(group_defines))
+        if group_includes:
+            output += cmake_group_template.format("target_include_directories", target, makelststr(group_includes))
+    return output
+
+
+def group_units(units: Mapping) -> dict:
+    """
+    Gather the sources, defines and includes of each group from the per-source flags.
+    """
+    groups = {}
+    for source, (group, unit_defines, unit_includes) in units.items():
+        group_sources, group_defines, group_includes = groups.setdefault(group, (set(), set(), set()))
+        group_sources.add(source)
+        group_defines.update(unit_defines)
+        group_includes.update(unit_includes)
+    return groups
+
+
+def render_cmakelist(name: str, result: BuildResult) -> str:
+    """
+    Return the CMakeLists.txt for a parse result.
+    """
+    if result.units is not None:
+        groups = group_units(result.units)
+        grouped_defines = set().union(*[group[1] for group in groups.values()])
+        grouped_includes = set().union(*[group[2] for group in groups.values()])
+        return make_grouped_cmakelist(name, groups, result.defines - grouped_defines,
+                                      result.includes - grouped_includes)
+    definelststr = makelststr(result.defines)
+    includelststr = makelststr(result.includes)
+    sourcelststr = makelststr(result.sources)
+    return cmake_template.format(name, definelststr, includelststr, name, sourcelststr)
+
+
+def make_cmakelist(args, result: BuildResult, profile: Optional[Profile] = None):
     """
     Create the CMakeLists.txt file.
     """
-    definelststr = makelststr(defines)
-    includelststr = makelststr(includes)
-    sourcelststr = makelststr(sources)
-    output = cmake_template.format(args.name, definelststr, includelststr, args.name, sourcelststr)
     fname = args.outdir + "/CMakeLists.txt"
-    with open(fname, "w") as f:
-        f.write(output)
-        loggerl.info("{} has been written".format(fname))
+    with profile.phase("render") if profile else contextlib.nullcontext():
+        output = render_cmakelist(args.name, result)
+    with profile.phase("write") if profile else contextlib.nullcontext():
+        write_atomic(fname, output)
+    logger.info("%s has been written", fname)
 
 
-def parse_build(args):
+def write_atomic(fname: str, output: str) -> None:
     """
-    Parse a build output file to extract data and create the CMakeLists.txt file.
+    Write output to fname via a temp file and a rename so readers never see a partial file.
+    """
+    tmpname = "{}.{}.{}.tmp".format(fname, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpname, "w") as f:
+            f.write(output)
+        os.replace(tmpname, fname)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+
+def parse_build(args) -> Optional[BuildResult]:
+    """
+    Parse a build output file to extract data, create the CMakeLists.txt file and return the result.
     """
     if os.path.isfile(args.buildfile) is False:
         logger.warning("{} is missing".format(args.buildfile))
-        return
+        return None
 
     logger.info("Parsing {}...".format(args.buildfile))
-    logger.info("Logging to {}".format(logfname))
+    if logfname:
+        logger.info("Logging to {}".format(logfname))
+
+    if not getattr(args, "profile", False):
+        result = BuildParser(args).parse()
+        make_cmakelist(args, result)
+        return result
+
+    profile = Profile()
+    result = ProfiledBuildParser(args, profile).parse()
+    make_cmakelist(args, result, profile)
+    count_result(profile, result)
+    for line in profile.report():
+        logger.info(line)
+    return result
+
+
+def count_result(profile: Profile, result: BuildResult) -> None:
+    """
+    Add the sizes of the result and the hits of the path cache to the counters of profile.
+    """
+    info = cached_rel_path.cache_info()
+    profile.counters.update({"defines": len(result.defines), "includes": len(result.includes),
+                             "sources": len(result.sources), "path cache hits": info.hits,
+                             "path cache misses": info.misses})
+
+
+manifest_keys = {"platform", "buildfile", "blddir", "name", "outdir"}
+
+
+def read_manifest(args) -> list:
+    """
+    Return the args of every platform in the manifest of args.
+
+    The manifest is a JSON list with an object per platform with the keys platform, buildfile,
+    blddir, name and outdir. Missing keys and all other options come from args.
+    """
+    with open(args.manifest) as f:
+        entries = json.load(f)
+    platforms = []
+    fnames = set()
+    for entry in entries:
+        unknown = set(entry) - manifest_keys
+        if unknown:
+            raise ValueError("{}: unknown keys {}".format(args.manifest, ", ".join(sorted(unknown))))
+        platform_args = Namespace(**vars(args))
+        vars(platform_args).update(entry)
+        # The workers of the batch pool can't start pools of their own.
+        platform_args.jobs = 1
+        platform_args.manifest = None
+        if not validate_args(platform_args):
+            raise ValueError("{}: no buildfile for platform {}".format(args.manifest, platform_args.platform))
+        fname = os.path.abspath(platform_args.outdir + "/CMakeLists.txt")
+        if fname in fnames:
+            raise ValueError("{}: more than one platform writes {}".format(args.manifest, fname))
+        fnames.add(fname)
+        platforms.append(platform_args)
+    return platforms
+
+
+def parse_platform(args) -> tuple:
+    """
+    Parse the build output of one platform of a batch in a worker process.
+
+    Return the rendered CMakeLists.txt, or None if the build output is missing, the number of
+    lines, the seconds it took and the lines of the --profile report. The report is logged by the
+    batch, so that the reports of the workers don't interleave.
+    """
+    if not os.path.isfile(args.buildfile):
+        logger.warning("{} is missing".format(args.buildfile))
+        return None, 0, 0.0, []
+    start = time.perf_counter()
+    if not getattr(args, "profile", False):
+        result = BuildParser(args).parse()
+        return render_cmakelist(args.name, result), result.nlines, time.perf_counter() - start, []
+
+    profile = Profile()
+    result = ProfiledBuildParser(args, profile).parse()
+    with profile.phase("render"):
+        output = render_cmakelist(args.name, result)
+    count_result(profile, result)
+    return output, result.nlines, time.perf_counter() - start, profile.report()
 
-    with open(args.buildfile) as f:
-        for line in f:
-            global currline
-            currline += 1
-            logger.debug("Processing line {}: {}".format(currline, line))
-            process_line(args, line)
 
-    # Further correct the lists to include the compiler and to remove unneeded stuff.
-    add_extras(args)
+def parse_manifest(args) -> dict:
+    """
+    Parse the build output of every platform in the manifest with a process pool and write all
+    of the CMakeLists.txt files once every parse is done.
+
+    Return the seconds each platform took to parse, by name.
+    """
+    platforms = read_manifest(args)
+    jobs = min(len(platforms), args.jobs if args.jobs > 0 else os.cpu_count()) or 1
+    logger.info("Parsing {} platforms with {} jobs".format(len(platforms), jobs))
+    start = time.perf_counter()
+    import multiprocessing
+    with multiprocessing.Pool(jobs) as pool:
+        results = pool.map(parse_platform, platforms, chunksize=1)
+    elapsed = time.perf_counter() - start
+
+    timings = {}
+    for platform_args, (output, nlines, platform_elapsed, report) in zip(platforms, results):
+        timings[platform_args.name] = platform_elapsed
+        if output is None:
+            continue
+        fname = platform_args.outdir + "/CMakeLists.txt"
+        write_atomic(fname, output)
+        logger.info("{:12} {:10} lines in {:8.3f}s, {}".format(platform_args.name, nlines, platform_elapsed, fname))
+        for line in report:
+            logger.info(line)
+    logger.info("Parsed {} platforms in {:.3f}s, {:.3f}s of parsing".format(
+        len(platforms), elapsed, sum(timings.values())))
+    return timings
+
+
+# file magic -> codec of compressed build logs
+log_codecs = [(b"\x1f\x8b", "gzip"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd")]
+
+
+def log_codec(path: str):
+    """
+    Return the codec a build log is compressed with, gzip, xz or zstd, or None if it is not compressed.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(6)
+    for codec_magic, codec in log_codecs:
+        if magic.startswith(codec_magic):
+            return codec
+    return None
 
-    make_cmakelist(args)
+
+def open_log(path: str, binary: bool = False):
+    """
+    Open a build log, decompressing it as it is read if it is compressed.
+
+    Text is decoded the same way open() decodes it. zstd needs the zstandard package.
+    """
+    codec = log_codec(path)
+    if codec is None:
+        return open(path, "rb") if binary else open(path)
+    if codec == "gzip":
+        import gzip
+        f = gzip.open(path, "rb")
+    elif codec == "xz":
+        import lzma
+        f = lzma.open(path, "rb")
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("{} is zstd compressed, install zstandard to read it".format(path)) from None
+        f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    return f if binary else io.TextIOWrapper(f)
+
+
+def split_chunks(path: str, chunk_size: int) -> list:
+    """
+    Split a file into (start, end) byte ranges of about chunk_size bytes that end on line boundaries.
+    """
+    size = os.path.getsize(path)
+    chunks = []
+    start = 0
+    with open(path, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = f.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def read_chunk(path: str, start: int, end: int):
+    """
+    Return a binary file of the bytes of a chunk of the file.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return io.BytesIO(data)
 
 
-def add_extras(args):
-    if args.platform == "thor":
-        includes.add("/opt/projects/ccxsw_tools/mentor_graphics/mgc-2018.070/toolchains/arm-none-eabi.2016.11"
-                     "/arm-none-eabi/include")
+def scan_chunk(path: str, start: int, end: int) -> tuple:
+    """
+    Return the number of lines and the last make directory, or None, of a chunk.
+    """
+    nlines = 0
+    last_mkdir = None
+    for line in io.TextIOWrapper(read_chunk(path, start, end)):
+        nlines += 1
+        if line.startswith("make"):
+            last_mkdir = get_mkdir(line) or last_mkdir
+    return nlines, last_mkdir
 
-    elif args.platform == "cmba":
-        includes.add("/projects/armds/include")
 
-    elif args.platform == "bnxt_en":
-        pass
+def parse_chunk(args, path: str, start: int, end: int, start_line: int, start_mkdir: str) -> tuple:
+    """
+    Parse a chunk of the file in a worker process and return the defines, includes and sources found.
 
-    elif args.platform == "bnxt-mt":
-        pass
+    The worker starts with the make directory and line count that the serial parse would have
+    at the start of the chunk so both parses see the same state for every line.
+    """
+    parser = BuildParser(args, start_mkdir)
+    parser.parse_log(read_chunk(path, start, end), start_line)
+    log_cache_info()
+    return parser.defines, parser.includes, parser.sources
+
+
+class ParseCache:
+    """
+    On-disk cache of parse results in sqlite so re-parsing a log only parses what changed.
+
+    There is one cache file per platform and build dir since both change the extracted values.
+    The lines table maps the hash of a compile line and its make directory to the values extracted
+    from it. The logs table keeps, for every log and extraction mode, how far it was parsed, a digest
+    of the bytes up to there and the make directory and values at that point, so an appended log
+    resumes from there.
+    """
+    version = "2"
+
+    def __init__(self, path: str):
+        self.path = path
+        import sqlite3
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != self.version:
+            self.db.execute("DROP TABLE IF EXISTS lines")
+            self.db.execute("DROP TABLE IF EXISTS logs")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.version,))
+        self.db.execute("CREATE TABLE IF NOT EXISTS lines "
+                        "(hash BLOB PRIMARY KEY, defines TEXT, includes TEXT, sources TEXT) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS logs "
+                        "(path TEXT, mode TEXT, offset INTEGER, digest BLOB, mkdir TEXT, "
+                        "defines TEXT, includes TEXT, sources TEXT, PRIMARY KEY (path, mode))")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def location(args) -> str:
+        """
+        Return the cache file for the platform and build dir of args.
+        """
+        import hashlib
+        key = hashlib.sha1(os.path.abspath(args.blddir).encode()).hexdigest()[:16]
+        return os.path.join(os.path.expanduser(args.cache_dir), "{}-{}.sqlite".format(args.platform, key))
+
+    def get_line(self, key: bytes):
+        row = self.db.execute("SELECT defines, includes, sources FROM lines WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [value.split("\n") if value else [] for value in row]
+
+    def put_line(self, key: bytes, line_defines: set, line_includes: set, line_sources: set) -> None:
+        self.db.execute("INSERT OR REPLACE INTO lines VALUES (?, ?, ?, ?)",
+                        (key, "\n".join(line_defines), "\n".join(line_includes), "\n".join(line_sources)))
+
+    def get_log(self, path: str, mode: str):
+        return self.db.execute("SELECT offset, digest, mkdir, defines, includes, sources FROM logs "
+                               "WHERE path = ? AND mode = ?", (path, mode)).fetchone()
+
+    def put_log(self, path: str, mode: str, offset: int, digest: bytes, state: tuple) -> None:
+        log_mkdir, log_defines, log_includes, log_sources = state
+        self.db.execute("INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (path, mode, offset, digest, log_mkdir, "\n".join(log_defines), "\n".join(log_includes),
+                         "\n".join(log_sources)))
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+
+# What tail_lines yields when the file it follows was truncated.
+log_truncated = object()
+
+
+def tail_lines(f, interval: float, idle_timeout: float = 0, follow: bool = True):
+    """
+    Yield lines from f as they are written, the way tail -f does.
+
+    None is yielded each time the end of the file is reached so the caller can act on what it
+    has seen so far, and log_truncated when the file was truncated and is read again from the
+    start, so the caller can drop what it has seen. Partial lines are held back until their
+    newline arrives. Streams that can't grow, like stdin, end at EOF; files end after idle_timeout
+    seconds without new data, or never if idle_timeout is 0.
+    """
+    partial = ""
+    idle = 0.0
+    while True:
+        line = f.readline()
+        if line:
+            idle = 0.0
+            if line.endswith("\n"):
+                yield partial + line
+                partial = ""
+            else:
+                partial += line
+            continue
+
+        if not follow or (idle_timeout and idle >= idle_timeout):
+            if partial:
+                yield partial
+            return
+
+        yield None
+        # The log was truncated or rewritten by a new build, so start over.
+        if os.fstat(f.fileno()).st_size < f.tell():
+            logger.info("{} was truncated, rereading".format(f.name))
+            f.seek(0)
+            partial = ""
+            yield log_truncated
+        time.sleep(interval)
+        idle += interval
+
+
+def update_cmakelist(args, parser: BuildParser, snapshot: tuple) -> tuple:
+    """
+    Rewrite the CMakeLists.txt file if the defines, includes or sources changed since snapshot.
+
+    The sets only grow, so their sizes are enough to tell if anything changed.
+    """
+    units = parser.units
+    current = (len(parser.defines), len(parser.includes), len(parser.sources), len(units) if units is not None else 0)
+    if current != snapshot:
+        make_cmakelist(args, parser.result())
+    return current
+
+
+def follow_build(args) -> BuildResult:
+    """
+    Follow a build output file, or stdin for -, that is still being written and keep the
+    CMakeLists.txt file up to date as new compile lines show up.
+    """
+    follow = args.buildfile != "-"
+    if follow:
+        while not os.path.isfile(args.buildfile):
+            logger.info("Waiting for {}...".format(args.buildfile))
+            time.sleep(args.interval)
+        if log_codec(args.buildfile):
+            # A compressed log is complete, there is nothing to wait for.
+            logger.info("{} is compressed, reading it once".format(args.buildfile))
+            follow = False
+        f = open_log(args.buildfile)
+    else:
+        f = sys.stdin
+
+    logger.info("Following {}...".format(args.buildfile))
+    parser = BuildParser(args)
+    parser.start_compile_commands()
+    trace = tracing()
+    nlines = 0
+    snapshot = None
+    last_update = time.monotonic()
+    try:
+        for line in tail_lines(f, args.interval, args.idle_timeout, follow):
+            if line is log_truncated:
+                # A new build: its values replace the ones of the previous build.
+                parser.finish_compile_commands()
+                parser = BuildParser(args)
+                parser.start_compile_commands()
+                nlines = 0
+                snapshot = None
+                continue
+            if line is not None:
+                nlines += 1
+                if trace:
+                    linefilter.lineno = nlines
+                    logger.debug("Processing line %d: %s", nlines, line)
+                parser.process_line(line)
+            # Update when caught up with the writer, but also while lines keep streaming in.
+            if line is None or time.monotonic() - last_update >= args.interval:
+                snapshot = update_cmakelist(args, parser, snapshot)
+                last_update = time.monotonic()
+    except KeyboardInterrupt:
+        logger.info("Stopped following {}".format(args.buildfile))
+    except BaseException:
+        parser.abort_compile_commands()
+        raise
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    parser.nlines = nlines
+    update_cmakelist(args, parser, snapshot)
+    parser.finish_compile_commands()
+    return parser.result()
 
 
 def create_parser():
@@ -315,11 +1482,45 @@ def create_parser():
     parser.add_argument("-V", "--version", action="version",
                         version="%(prog)s (version {version})".format(version="0.0.1"))
 
+    parser.add_argument("-l", "--logfile", help="write a debug trace of the parsing to this file. Default: no trace")
     parser.add_argument("-b", "--blddir", help="the path to the dir where the make build started.")
     parser.add_argument("-o", "--outdir", help="the path to the output dir. Default: /tmp", default="/tmp")
     parser.add_argument("-n", "--name", help="the project name. Default: Cumulus", default="Cumulus")
     parser.add_argument("-p", "--platform", help="the platform, thor or cmba(wh+). Default thor.", default=None)
-    parser.add_argument("buildfile", help="the build output text file")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="the number of processes used to parse the build output, or the platforms of a "
+                             "--manifest. 0 uses all cores. Default: 1, or all cores with --manifest")
+    parser.add_argument("--legacy-regex", action="store_true",
+                        help="extract with the original per-value regexes instead of the tokenizer, to diff the outputs")
+    parser.add_argument("-c", "--cache", action="store_true",
+                        help="keep parse results in an on-disk cache and only parse new or changed lines. "
+                             "Not with -j, except for the platforms of a --manifest")
+    parser.add_argument("--cache-dir", default="~/.cache/cmaker",
+                        help="the dir for the parse cache, one file per platform and blddir. Default: ~/.cache/cmaker")
+    parser.add_argument("--compile-commands", action="store_true",
+                        help="also write a compile_commands.json with one entry per compile line to the output dir")
+    parser.add_argument("-g", "--group-by", choices=["none", "flags", "dir"], default="none",
+                        help="put sources in an object library per group of identical flags or per directory "
+                             "instead of applying all flags to all sources. Default: none")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="keep reading the build output as it grows and update the CMakeLists.txt as it changes")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between checks for new output when following. Default: 1.0")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        help="stop following after this many seconds without new output. Default: 0, never stop")
+    parser.add_argument("--fixups", default=default_fixups,
+                        help="the JSON file with the path prefix rules and extra includes of each platform. "
+                             "Default: fixups.json next to cmaker.py")
+    parser.add_argument("--profile", action="store_true",
+                        help="log the time of each phase of the parse and counters of what was found")
+    parser.add_argument("--profile-out",
+                        help="write cProfile stats of the run to this file, to read with python -m pstats")
+    parser.add_argument("-m", "--manifest",
+                        help="a JSON list of platforms to parse at once, each with platform, buildfile, blddir, name "
+                             "and outdir keys. Missing keys come from the other options")
+    parser.add_argument("buildfile", nargs="?",
+                        help="the build output text file, or - to read stdin. gzip, xz and zstd logs are decompressed "
+                             "as they are read")
     return parser
 
 
@@ -334,6 +1535,15 @@ def print_args(args):
 
 
 def validate_args(args):
+    if args.jobs is None:
+        args.jobs = 0 if args.manifest else 1
+    if not args.buildfile and not args.manifest:
+        print("A buildfile or a --manifest is needed")
+        return False
+    if args.cache and args.jobs != 1 and not args.manifest:
+        # The chunks of a parallel parse neither read nor fill the cache.
+        print("--cache parses serially, it can't be used with -j {}".format(args.jobs))
+        return False
     if not args.blddir:
         print("Using . as blddir")
         args.blddir = "."
@@ -341,12 +1551,29 @@ def validate_args(args):
 
 
 def run(args):
-    if args.verbose > 0:
-        debug(logging.DEBUG, logging.DEBUG)
+    debug(logging.DEBUG if args.verbose > 0 else logging.INFO, logging.DEBUG)
+    if args.logfile:
+        logfile(args.logfile)
     if not validate_args(args):
         return
     print_args(args)
-    parse_build(args)
+    profiler = None
+    if args.profile_out:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if args.manifest:
+            parse_manifest(args)
+        elif args.follow or args.buildfile == "-":
+            follow_build(args)
+        else:
+            parse_build(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile_out)
+            logger.info("Profile stats have been written to {}".format(args.profile_out))
 
 
 if __name__ == "__main__":
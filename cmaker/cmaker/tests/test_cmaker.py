@@ -1,7 +1,16 @@
+import gzip
+import io
+import json
 import logging
+import lzma
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from unittest import TestCase
-from cmaker import cmaker
+from cmaker import bench, cmaker
 
 
 class Args:
@@ -83,3 +92,438 @@ class Test(TestCase):
         self.assertTrue(self.string_in_file("MODULE"))
         self.assertTrue(self.string_in_file(" ../../usr/src/kernels/3.10.0-957.27.2.el7.x86_64/arch/x86/include"))
         self.assertTrue(self.string_in_file(" bnxt.c"))
+
+    def test_follow_build(self):
+        self.args.buildfile = "build.thor.txt"
+        self.args.platform = "thor"
+        self.args.name = "thor"
+        self.args.blddir = "."
+        self.args.interval = 0.01
+        self.args.idle_timeout = 0.05
+        cmaker.follow_build(self.args)
+        self.assertTrue(os.path.exists(self.cmakefile))
+        self.assertTrue(self.string_in_file("PLDM_FW_UPDATE"))
+        self.assertTrue(self.string_in_file(" ../core/HWRM/hwrm_comm_nucleus.c"))
+
+    def test_follow_build_truncated(self):
+        # A build that starts over in the same log drops the values of the previous build.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.args.buildfile = os.path.join(tmpdir, "build.txt")
+            self.args.platform = "thor"
+            self.args.name = "thor"
+            self.args.blddir = "."
+            self.args.interval = 0.01
+            self.args.idle_timeout = 0.5
+            with open(self.args.buildfile, "w") as f:
+                f.write("gcc -DOLD_BUILD -c old.c\n")
+            results = []
+            thread = threading.Thread(target=lambda: results.append(cmaker.follow_build(self.args)))
+            thread.start()
+            time.sleep(0.2)
+            with open(self.args.buildfile, "w") as f:
+                f.write("gcc -DNEW -c new.c\n")
+            thread.join()
+        self.assertEqual((frozenset({"NEW"}), frozenset({"new.c"})), (results[0].defines, results[0].sources))
+        self.assertFalse(self.string_in_file("OLD_BUILD"))
+
+    def test_tail_lines(self):
+        with open("follow.txt", "w") as f:
+            f.write("first\nsecond")
+        with open("follow.txt") as f:
+            lines = cmaker.tail_lines(f, 0.01)
+            self.assertEqual("first\n", next(lines))
+            self.assertIsNone(next(lines))
+            with open("follow.txt", "a") as w:
+                w.write(" half\n")
+            self.assertEqual("second half\n", next(lines))
+        os.remove("follow.txt")
+
+    def test_update_cmakelist_unchanged(self):
+        self.args.platform = "thor"
+        self.args.name = "thor"
+        parser = cmaker.BuildParser(self.args)
+        snapshot = cmaker.update_cmakelist(self.args, parser, None)
+        mtime = os.stat(self.cmakefile).st_mtime_ns
+        self.assertEqual(snapshot, cmaker.update_cmakelist(self.args, parser, snapshot))
+        self.assertEqual(mtime, os.stat(self.cmakefile).st_mtime_ns)
+
+    def parse_serial_and_parallel(self, buildfile: str, platform: str, blddir: str):
+        self.args.buildfile = buildfile
+        self.args.platform = platform
+        self.args.blddir = blddir
+        results = []
+        for jobs in [1, 3]:
+            parser = cmaker.BuildParser(self.args)
+            self.args.jobs = jobs
+            if jobs == 1:
+                parser.parse_lines(open(buildfile))
+            else:
+                # Tiny chunks so the make directory has to carry over between chunks.
+                parser.parse_parallel(chunk_size=64)
+            results.append((parser.defines, parser.includes, parser.sources, parser.mkdir))
+        return results
+
+    def test_parse_build_parallel_bnxtmt(self):
+        serial, parallel = self.parse_serial_and_parallel(
+            "build.bnxtmt.txt", "bnxt-mt", "/git/int_nxt/main/Cumulus/util/bnxt-mt/build")
+        self.assertIn("../src/bnxtmt/tcl/generic/regcomp.c", parallel[2])
+        self.assertEqual(serial, parallel)
+
+    def test_parse_build_parallel_thor(self):
+        serial, parallel = self.parse_serial_and_parallel("build.thor.txt", "thor", ".")
+        self.assertEqual(serial, parallel)
+
+    def test_split_chunks(self):
+        chunks = cmaker.split_chunks("build.bnxtmt.txt", 64)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(0, chunks[0][0])
+        self.assertEqual(os.path.getsize("build.bnxtmt.txt"), chunks[-1][1])
+        with open("build.bnxtmt.txt", "rb") as f:
+            data = f.read()
+        for start, end in chunks[1:]:
+            self.assertEqual(b"\n", data[start - 1:start])
+
+    def test_extract_tokens_matches_regex(self):
+        self.args.blddir = "."
+        self.args.jobs = 1
+        for buildfile, platform in [("build.thor.txt", "thor"), ("build.lcdiag.txt", "lcdiag"),
+                                    ("build.bnxtmt.txt", "bnxt-mt"), ("build.bnxt_en.txt", "bnxt_en")]:
+            self.args.platform = platform
+            results = []
+            for legacy_regex in [True, False]:
+                parser = cmaker.BuildParser(self.args)
+                self.args.legacy_regex = legacy_regex
+                parser.parse_lines(open(buildfile))
+                results.append((parser.defines, parser.includes, parser.sources))
+            self.assertEqual(results[0], results[1], buildfile)
+
+    def test_extract_tokens_quoted_file(self):
+        parser = cmaker.BuildParser(self.args)
+        parser.extract_tokens('armcc -D__FILE__="Cumulus/firmware/core/qos profiles/thor_1p.c" -D NXT -I "../inc dir" '
+                              '../core/thor_1p.c -o thor_1p.o\n', "", "", ".")
+        self.assertEqual({'__FILE__="Cumulus/firmware/core/qos profiles/thor_1p.c"', "NXT"}, parser.defines)
+        self.assertEqual({"../inc dir"}, parser.includes)
+        self.assertEqual({"../core/thor_1p.c"}, parser.sources)
+
+    def test_cached_rel_path(self):
+        cmaker.cached_rel_path.cache_clear()
+        self.assertEqual("../RTOS/Nucleus_3/os/include",
+                         cmaker.cached_rel_path('"os/include"', "/git/THOR/../RTOS/Nucleus_3", "/git/THOR"))
+        self.assertEqual("../RTOS/Nucleus_3/os/include",
+                         cmaker.cached_rel_path('"os/include"', "/git/THOR/../RTOS/Nucleus_3", "/git/THOR"))
+        info = cmaker.cached_rel_path.cache_info()
+        self.assertEqual((1, 1), (info.hits, info.misses))
+
+    def parse_cached(self):
+        parser = cmaker.BuildParser(self.args)
+        nlines = parser.parse_cached()
+        return nlines, (parser.defines, parser.includes, parser.sources)
+
+    def test_parse_build_cached(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            buildfile = os.path.join(tmpdir, "build.txt")
+            self.args.buildfile = buildfile
+            self.args.platform = "bnxt-mt"
+            self.args.blddir = "/git/int_nxt/main/Cumulus/util/bnxt-mt/build"
+            self.args.cache_dir = tmpdir
+            with open("build.bnxtmt.txt") as f:
+                lines = f.readlines()
+            with open(buildfile, "w") as f:
+                f.writelines(lines[:8])
+
+            nlines, first = self.parse_cached()
+            self.assertEqual(8, nlines)
+            # Unchanged log: nothing left to parse.
+            self.assertEqual((0, first), self.parse_cached())
+
+            # Appended log: only the new lines are parsed and the result matches a full parse.
+            with open(buildfile, "a") as f:
+                f.writelines(lines[8:])
+            nlines, appended = self.parse_cached()
+            self.assertEqual(len(lines) - 8, nlines)
+            _, full = self.parse_serial_and_parallel("build.bnxtmt.txt", "bnxt-mt", self.args.blddir)
+            self.assertEqual(full[:3], appended)
+
+            # Changed log: everything is read again, compile lines come from the cache.
+            self.args.buildfile = buildfile
+            with open(buildfile, "w") as f:
+                f.writelines(["changed\n"] + lines)
+            nlines, changed = self.parse_cached()
+            self.assertEqual(len(lines) + 1, nlines)
+            self.assertEqual(full[:3], changed)
+
+    def test_parse_cached_mode(self):
+        # The saved log state only applies to the extraction mode it was parsed with.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.args.buildfile = os.path.join(tmpdir, "build.txt")
+            self.args.platform = "thor"
+            self.args.blddir = "."
+            self.args.cache_dir = tmpdir
+            with open(self.args.buildfile, "w") as f:
+                f.write("gcc -D SPACED -DJOINED -c a.c\n")
+            self.assertEqual({"JOINED", "SPACED"}, self.parse_cached()[1][0])
+            self.args.legacy_regex = True
+            nlines, (defines, _, _) = self.parse_cached()
+            self.assertEqual((1, {"JOINED"}), (nlines, defines))
+
+    def test_parse_cached_jobs(self):
+        # A parallel parse doesn't use the cache, so the two can't be asked for together.
+        parser = cmaker.create_parser()
+        self.assertFalse(cmaker.validate_args(parser.parse_args(["-c", "-j", "4", "build.txt"])))
+        self.assertTrue(cmaker.validate_args(parser.parse_args(["-c", "build.txt"])))
+        self.assertTrue(cmaker.validate_args(parser.parse_args(["-c", "-j", "4", "-m", "manifest.json"])))
+
+    def test_parse_cached_replaced_compressed(self):
+        # A compressed log replaced by a shorter one is read again from the start.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.args.buildfile = os.path.join(tmpdir, "build.txt.gz")
+            self.args.platform = "bnxt-mt"
+            self.args.blddir = "/git/int_nxt/main/Cumulus/util/bnxt-mt/build"
+            self.args.cache_dir = tmpdir
+            with open("build.bnxtmt.txt", "rb") as f:
+                lines = f.readlines()
+            with gzip.open(self.args.buildfile, "wb") as f:
+                f.writelines(lines)
+            self.parse_cached()
+            with gzip.open(self.args.buildfile, "wb") as f:
+                f.writelines(lines[:8])
+            nlines, shorter = self.parse_cached()
+            self.assertEqual(8, nlines)
+            self.args.buildfile = os.path.join(tmpdir, "build.txt")
+            with open(self.args.buildfile, "wb") as f:
+                f.writelines(lines[:8])
+            self.assertEqual(shorter, cmaker.BuildParser(self.args).parse()[:3])
+
+    def test_compile_commands(self):
+        self.args.buildfile = "build.bnxtmt.txt"
+        self.args.platform = "bnxt-mt"
+        self.args.name = "bnxt-mt"
+        self.args.blddir = "/git/int_nxt/main/Cumulus/util/bnxt-mt/build"
+        self.args.compile_commands = True
+        cmaker.parse_build(self.args)
+        with open("compile_commands.json") as f:
+            entries = json.load(f)
+        os.remove("compile_commands.json")
+        self.assertEqual(2, len(entries))
+        self.assertEqual({"directory": "/git/int_nxt/main/Cumulus/util/bnxt-mt/src/bnxtmt/tcl/unix",
+                          "command": "gcc -c -fPIC  -MMD -g -I. -I./../unix -I./../generic -I./../tcl_dbg "
+                                     "-I./../../../../../../common/nitro-headers/headers ./../generic/regcomp.c "
+                                     "-o obj/regcomp.o",
+                          "file": "./../generic/regcomp.c"}, entries[1])
+
+    def test_compile_commands_error(self):
+        # A parse that fails leaves no temp file behind.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.args.buildfile = tmpdir
+            self.args.platform = "thor"
+            self.args.blddir = "."
+            self.args.outdir = tmpdir
+            self.args.compile_commands = True
+            with self.assertRaises(OSError):
+                cmaker.BuildParser(self.args).parse()
+            self.assertEqual([], os.listdir(tmpdir))
+
+    def test_group_by_flags(self):
+        self.args.buildfile = "build.thor.txt"
+        self.args.platform = "thor"
+        self.args.name = "thor"
+        self.args.blddir = "."
+        self.args.group_by = "flags"
+        result = cmaker.parse_build(self.args)
+        self.assertEqual(result.sources, frozenset(result.units))
+        self.assertTrue(self.string_in_file("add_library(thor_001 OBJECT"))
+        self.assertTrue(self.string_in_file("add_library(thor_003 OBJECT"))
+        self.assertTrue(self.string_in_file("target_compile_definitions(thor_002 PRIVATE\n  BRCM_PRIMATE_MODS=1\n"))
+        self.assertFalse(self.string_in_file("add_executable"))
+
+    def test_group_by_flags_file_define(self):
+        # Every source has its own __FILE__ define, which must not give it its own target.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.args.buildfile = os.path.join(tmpdir, "build.txt")
+            self.args.platform = "thor"
+            self.args.blddir = "."
+            self.args.group_by = "flags"
+            with open(self.args.buildfile, "w") as f:
+                for name in ["a", "b"]:
+                    f.write('armcc -DNXT -D__FILE__="core/{0}.c" -I../inc -c ../core/{0}.c\n'.format(name))
+            result = cmaker.BuildParser(self.args).parse()
+        self.assertEqual(2, len(result.units))
+        self.assertEqual(1, len({group for group, _, _ in result.units.values()}))
+
+    def test_parse_platforms_in_threads(self):
+        platforms = [("build.thor.txt", "thor", "."), ("build.lcdiag.txt", "lcdiag", "."),
+                     ("build.bnxtmt.txt", "bnxt-mt", "/git/int_nxt/main/Cumulus/util/bnxt-mt/build"),
+                     ("build.bnxt_en.txt", "bnxt_en", "/git/nxt-linux-drivers/v3")]
+
+        def parse(buildfile: str, platform: str, blddir: str):
+            args = Args()
+            args.buildfile = buildfile
+            args.platform = platform
+            args.blddir = blddir
+            return cmaker.BuildParser(args).parse()
+
+        serial = {entry[1]: parse(*entry) for entry in platforms}
+        threaded = {}
+        threads = [threading.Thread(target=lambda entry=entry: threaded.update({entry[1]: parse(*entry)}))
+                   for entry in platforms * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(serial, threaded)
+        self.assertIn("../core/HWRM/hwrm_comm_nucleus.c", threaded["thor"].sources)
+        self.assertNotIn("../core/HWRM/hwrm_comm_nucleus.c", threaded["bnxt-mt"].sources)
+        self.assertIsInstance(threaded["thor"].defines, frozenset)
+
+    def test_parse_platform_profile(self):
+        # --profile in a batch times the same parse and hands the report back to be logged.
+        args = cmaker.create_parser().parse_args(["-p", "thor", "-b", ".", "build.thor.txt"])
+        self.assertTrue(cmaker.validate_args(args))
+        output, nlines, _, report = cmaker.parse_platform(args)
+        self.assertEqual([], report)
+        args.profile = True
+        profiled = cmaker.parse_platform(args)
+        self.assertEqual((output, nlines), profiled[:2])
+        self.assertIn("tokens", "\n".join(profiled[3]))
+
+    def test_parse_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            platforms = [{"platform": "thor", "buildfile": "build.thor.txt", "blddir": ".", "name": "thor"},
+                         {"platform": "bnxt-mt", "buildfile": "build.bnxtmt.txt", "name": "bnxt-mt",
+                          "blddir": "/git/int_nxt/main/Cumulus/util/bnxt-mt/build"}]
+            for platform in platforms:
+                platform["outdir"] = os.path.join(tmpdir, platform["name"])
+                os.mkdir(platform["outdir"])
+            manifest = os.path.join(tmpdir, "manifest.json")
+            with open(manifest, "w") as f:
+                json.dump(platforms, f)
+            args = cmaker.create_parser().parse_args(["-m", manifest, "-j", "2"])
+            self.assertTrue(cmaker.validate_args(args))
+            timings = cmaker.parse_manifest(args)
+            self.assertEqual({"thor", "bnxt-mt"}, set(timings))
+
+            for platform in platforms:
+                with open(os.path.join(platform["outdir"], "CMakeLists.txt")) as f:
+                    batch = f.read()
+                vars(args).update(platform, manifest=None, jobs=1)
+                cmaker.parse_build(args)
+                with open(os.path.join(platform["outdir"], "CMakeLists.txt")) as f:
+                    self.assertEqual(f.read(), batch)
+
+            with open(manifest, "w") as f:
+                json.dump([{"platform": "thor", "bulidfile": "build.thor.txt"}], f)
+            with self.assertRaises(ValueError):
+                cmaker.read_manifest(cmaker.create_parser().parse_args(["-m", manifest]))
+            # Without a buildfile in the entry or on the command line there is nothing to parse.
+            with open(manifest, "w") as f:
+                json.dump([{"platform": "thor", "outdir": tmpdir}], f)
+            with self.assertRaises(ValueError):
+                cmaker.read_manifest(cmaker.create_parser().parse_args(["-m", manifest]))
+
+    def test_fixup_rules(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fixups = os.path.join(tmpdir, "fixups.json")
+            with open(fixups, "w") as f:
+                json.dump({"fw": {"rules": [{"match": ["-Ibsp"], "prefix": "{blddir}/../RTOS"},
+                                            {"match": ["tlv"], "mkdir": ["APE"], "prefix": "{blddir}/.."},
+                                            {"match": ["tlv", "bc1"], "prefix": "{mkdir}"}],
+                                  "extra_includes": ["/opt/include"]},
+                           "fw2": {"base": "fw", "extra_includes": []}}, f)
+            self.args.fixups = fixups
+            self.args.platform = "fw"
+            rules = cmaker.platform_fixups(self.args)
+            self.assertEqual("/b/../RTOS", rules.get_prefix("gcc -Ibsp tlv bc1 x.c", "/m/APE", "/b"))
+            self.assertEqual("/b/..", rules.get_prefix("gcc tlv x.c", "/m/APE", "/b"))
+            self.assertEqual("/m/KONG", rules.get_prefix("gcc tlv x.c", "/m/KONG", "/b"))
+            self.assertEqual("/m/KONG", rules.get_prefix("gcc bc1 x.c", "/m/KONG", "/b"))
+            self.assertEqual("", rules.get_prefix("gcc x.c", "/m/KONG", "/b"))
+            self.assertEqual({"/opt/include"}, rules.extra_includes)
+
+            self.args.platform = "fw2"
+            self.assertEqual(set(), cmaker.platform_fixups(self.args).extra_includes)
+            self.assertEqual("/b/..", cmaker.platform_fixups(self.args).get_prefix("gcc tlv x.c", "/m/APE", "/b"))
+
+            self.args.platform = "unknown"
+            self.assertEqual("", cmaker.platform_fixups(self.args).get_prefix("gcc -Ibsp x.c", ".", "/b"))
+
+    def test_generated_logs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for compiler, (platform, blddir) in bench.compilers.items():
+                buildfile = os.path.join(tmpdir, "build.txt")
+                bench.generate_log(buildfile, 300, compiler=compiler)
+                with open(buildfile) as f:
+                    log = f.read()
+                self.assertIn("Entering directory", log)
+                self.assertTrue(compiler == "gcc" or '\'-D__FILE__="Cumulus/firmware/' in log)
+                serial, parallel = self.parse_serial_and_parallel(buildfile, platform, blddir)
+                self.assertTrue(serial[2])
+                self.assertEqual(serial, parallel)
+
+    def test_profile(self):
+        self.args.buildfile = "build.thor.txt"
+        self.args.platform = "thor"
+        self.args.name = "thor"
+        self.args.blddir = "."
+        self.args.profile = True
+        with self.assertLogs(cmaker.logger) as logs:
+            cmaker.parse_build(self.args)
+        output = "\n".join(logs.output)
+        for phase in cmaker.Profile.phases + ["other", "total"]:
+            self.assertRegex(output, r"\] {} +\d".format(phase))
+        self.assertIn("compile lines: 3, lines: 6, defines: ", output)
+
+    def test_compressed_logs(self):
+        self.args.platform = "bnxt-mt"
+        self.args.blddir = "/git/int_nxt/main/Cumulus/util/bnxt-mt/build"
+        self.args.buildfile = "build.bnxtmt.txt"
+        expected = cmaker.BuildParser(self.args).parse()
+        with open("build.bnxtmt.txt", "rb") as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.args.cache_dir = tmpdir
+            for codec, module in [("gzip", gzip), ("xz", lzma)]:
+                self.args.buildfile = os.path.join(tmpdir, "build.txt." + codec)
+                with module.open(self.args.buildfile, "wb") as f:
+                    f.write(data)
+                self.assertEqual(codec, cmaker.log_codec(self.args.buildfile))
+                for options in [{"jobs": 1}, {"jobs": 2}, {"jobs": 1, "cache": True}]:
+                    vars(self.args).update(options)
+                    self.assertEqual(expected, cmaker.BuildParser(self.args).parse(), (codec, options))
+                self.args.cache = False
+        self.assertIsNone(cmaker.log_codec("build.bnxtmt.txt"))
+
+    def test_import_is_cheap(self):
+        # Importing cmaker must not configure logging or load the modules only some runs need.
+        code = ("import logging, sys; from cmaker import cmaker; "
+                "print(len(cmaker.logger.handlers), len(logging.getLogger().handlers), "
+                "[m for m in ('multiprocessing', 'sqlite3', 'hashlib', 'gzip', 'lzma', 'cProfile') if m in sys.modules])")
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(cmaker.__file__)),
+                                check=True, capture_output=True, text=True).stdout
+        self.assertEqual("0 0 []\n", output)
+
+    def test_parse_blocks(self):
+        self.args.blddir = "."
+        self.args.jobs = 1
+        cases = []
+        for buildfile, platform in [("build.thor.txt", "thor"), ("build.lcdiag.txt", "lcdiag"),
+                                    ("build.bnxtmt.txt", "bnxt-mt")]:
+            with open(buildfile, "rb") as f:
+                cases.append((buildfile, platform, f.read()))
+        # Carriage returns, a line longer than a block, non-ASCII bytes and no newline at the end.
+        text = ("make[1]: Entering directory `/git/a'\r\ngcc -DA -c a.c\rnoise\r"
+                "\xa0gcc -DB -I" + "x" * 200 + " -c b.c\nmake[1]: Leaving directory `/git/a'\n"
+                "é warning\n  armcc -DC -c c.c\nmake: Entering directory `/git/b'\ngcc -DD -c d.c")
+        cases.append(("crlf", "lcdiag", text.encode("utf-8")))
+        cases.append(("lf", "lcdiag", text.replace("\r", "").encode("utf-8")))
+        for name, platform, data in cases:
+            self.args.platform = platform
+            parser = cmaker.BuildParser(self.args)
+            nlines = parser.parse_lines(io.TextIOWrapper(io.BytesIO(data), "utf-8"))
+            expected = (nlines, parser.defines, parser.includes, parser.sources, parser.mkdir)
+            for block_size in [0, 64]:
+                parser = cmaker.BuildParser(self.args)
+                nlines = parser.parse_blocks(io.BytesIO(data), "utf-8", block_size)
+                self.assertEqual(expected, (nlines, parser.defines, parser.includes, parser.sources, parser.mkdir),
+                                 (name, block_size))
+        self.assertEqual({"A", "B", "C", "D"}, parser.defines)
+        self.assertEqual("/git/b", parser.mkdir)